@@ -0,0 +1,447 @@
+"""Нагрузочные замеры бота на синтетических данных
+
+Примеры:
+    python bench.py generate --events 100000 --chats 5000 -o events.json
+    python bench.py run --events 1000,10000,100000 -o bench.json
+    python bench.py compare old.json new.json
+
+Результаты пишутся в JSON: список замеров {events, metric, value, unit},
+чтобы прогоны разных версий можно было сравнить командой compare.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+
+import main
+
+REPEAT_WEIGHTS = {"once": 50, "daily": 20, "weekly": 20, "monthly": 10}
+NOTIFY_SETS = [[60], [30], [15], [0], [60, 0], [1440, 60], [60, 30, 15, 0],
+               [2880, 1440, 60, 0]]
+# Разброс дат событий вокруг текущего момента (дни)
+SPREAD_DAYS = 180
+# Сколько отметок доставки писать одним групповым коммитом
+JOURNAL_BATCH = 500
+
+# ============= ГЕНЕРАТОР ДАННЫХ =============
+
+
+def past_occurrences(event_dt, repeat, now, limit):
+    """Последние limit повторений события до now (от старых к новым)"""
+    if event_dt > now:
+        return []
+    if repeat == "once":
+        return [event_dt]
+    result = []
+    occurrence = event_dt
+    # Начинаем не с самой даты, а незадолго до нужных повторений
+    start = now - timedelta(days=31 * limit)
+    if occurrence < start:
+        occurrence = main._occurrence_after(event_dt, repeat, start)
+    while occurrence and occurrence <= now:
+        result.append(occurrence)
+        occurrence = main._occurrence_after(event_dt, repeat, occurrence)
+    return result[-limit:]
+
+
+def generate_events(count, chats, history=20, legacy=False, seed=1):
+    """Синтетические события: чаты разного размера, смесь повторений
+
+    Размеры чатов распределены по Парето: немного больших групп
+    и много маленьких личных чатов. В legacy режиме события пишутся в
+    формате версии 1 (event_time и длинный список sent_notifications).
+    """
+    rng = random.Random(seed)
+    now = datetime.now(pytz.UTC).replace(second=0, microsecond=0)
+    chat_ids = [
+        -1000000000000 - i if i % 10 == 0 else 100000 + i for i in range(chats)
+    ]
+    weights = [rng.paretovariate(1.2) for _ in chat_ids]
+    repeats = list(REPEAT_WEIGHTS)
+    repeat_weights = list(REPEAT_WEIGHTS.values())
+
+    events = []
+    for chat_id in rng.choices(chat_ids, weights, k=count):
+        repeat = rng.choices(repeats, repeat_weights)[0]
+        event_dt = now + timedelta(
+            minutes=rng.randint(-SPREAD_DAYS * 1440, SPREAD_DAYS * 1440))
+        notify = rng.choice(NOTIFY_SETS)
+        created_at = event_dt - timedelta(days=SPREAD_DAYS)
+        event = {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "chat_id": chat_id,
+            "title": f"Событие {len(events) + 1}",
+            "repeat": repeat,
+            "notify_minutes": notify,
+            "created_by": chat_id if chat_id > 0 else 1,
+            "created_at": created_at.replace(tzinfo=None).isoformat(),
+        }
+
+        past = past_occurrences(event_dt, repeat, now, history)
+        if legacy:
+            event["event_time"] = event_dt.isoformat()
+            event["sent_notifications"] = [
+                f"{occurrence.isoformat()}_{minutes}" for occurrence in past
+                for minutes in notify
+            ]
+        else:
+            event["event_at"] = int(event_dt.timestamp())
+            event["delivered"] = {
+                str(minutes): int(past[-1].timestamp())
+                for minutes in notify
+            } if past else {}
+        events.append(event)
+
+    data = {"events": events}
+    if not legacy:
+        data["version"] = main.SCHEMA_VERSION
+    return data
+
+
+def write_dataset(path, data):
+    if "version" not in data:
+        # Старый формат: весь файл одной строкой
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        return
+    meta = {key: value for key, value in data.items() if key != "events"}
+    main.save_data(json.dumps(meta), map(main.dump_event, data["events"]),
+                   path)
+
+
+# ============= ЗАМЕРЫ =============
+
+
+class Results:
+    """Накопитель замеров"""
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, events, metric, value, unit):
+        self.rows.append({
+            "events": events,
+            "metric": metric,
+            "value": round(value, 6),
+            "unit": unit
+        })
+        print(f"  {metric:<28} {value:>14.3f} {unit}", file=sys.stderr)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class FakeMessage:
+    """Сообщение с кнопками, правки которого никуда не уходят"""
+
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, *args, **kwargs):
+        pass
+
+    async def reply_text(self, *args, **kwargs):
+        return self
+
+
+class FakeQuery:
+
+    def __init__(self, chat_id, message_id, data):
+        self.data = data
+        self.message = FakeMessage(chat_id, message_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class FakeChat:
+
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+
+    def __init__(self, chat_id, message_id, data):
+        self.callback_query = FakeQuery(chat_id, message_id, data)
+        self.effective_chat = FakeChat(chat_id)
+
+
+def bench_store(results, count, store_cls):
+    """Загрузка, снимок и память хранилища"""
+    store = store_cls()
+    load_s, _ = timed(store.load)
+    results.add(count, "store_load", load_s, "s")
+
+    store = store_cls()
+    tracemalloc.start()
+    store.load()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.add(count, "store_load_peak_memory", peak / 2**20, "MiB")
+
+    # Сборка снимка в event loop; запись идёт уже в потоке ввода-вывода
+    store._needs_snapshot = True
+    take_s, batch = timed(store._take_batch)
+    results.add(count, "store_snapshot_on_loop", take_s * 1e3, "ms")
+    store._finish_batch(batch, store._write_batch(batch))
+
+    snapshot_s, _ = timed(store.compact)
+    results.add(count, "store_snapshot", snapshot_s, "s")
+    return store
+
+
+async def bench_journal(results, count, store, now):
+    """Групповой коммит отметок доставки
+
+    Записей меньше JOURNAL_COMPACT_RECORDS, чтобы замерить сам журнал,
+    а не сворачивание в снимок (его меряет store_snapshot).
+    """
+    events = list(store.events)[:JOURNAL_BATCH]
+    started = time.perf_counter()
+    for event in events:
+        store.mark_delivered(event, event["notify_minutes"][0], now)
+    await store.flush_async()
+    elapsed = time.perf_counter() - started
+    results.add(count, "journal_commit", elapsed, "s")
+
+
+def bench_occurrences(results, count, store, now):
+    """Стоимость расчёта следующего повторения"""
+    events = list(store.events)
+    elapsed, _ = timed(lambda: [
+        main.get_next_occurrence(main.event_datetime(e), e["repeat"], now)
+        for e in events
+    ])
+    results.add(count, "next_occurrence", elapsed / len(events) * 1e6, "us")
+
+    elapsed, _ = timed(main.get_next_occurrences,
+                       [(main.event_datetime(e), e["repeat"], now)
+                        for e in events])
+    results.add(count, "next_occurrences_batch", elapsed / len(events) * 1e6,
+                "us")
+
+
+def bench_scheduler(results, count, store, now, hours, step):
+    """Перестройка таблицы напоминаний и стоимость тиков за hours часов"""
+    elapsed, _ = timed(main.scheduler.rebuild, store.events, now)
+    results.add(count, "scheduler_rebuild", elapsed, "s")
+    results.add(count, "scheduler_rows", len(main.scheduler), "rows")
+
+    ticks = []
+    fired = 0
+    moment = now
+    end = now + timedelta(hours=hours)
+    while moment < end:
+        moment += timedelta(seconds=step)
+        started = time.perf_counter()
+        due = main.scheduler.pop_due(moment + main.COALESCE_WINDOW)
+        ticks.append(time.perf_counter() - started)
+        fired += len(due)
+
+    results.add(count, "tick_mean", statistics.fmean(ticks) * 1e6, "us")
+    results.add(count, "tick_p95", percentile(ticks, 0.95) * 1e6, "us")
+    results.add(count, "tick_max", max(ticks) * 1e6, "us")
+    results.add(count, "reminders_fired", fired / hours * 24, "per_day")
+
+
+async def bench_handlers(results, count, store, samples):
+    """Задержка обработчиков кнопок списка и удаления"""
+    chats = sorted(store._by_chat, key=lambda c: -len(store._by_chat[c]))
+    largest = chats[0]
+    results.add(count, "largest_chat_events", len(store._by_chat[largest]),
+                "events")
+
+    for code, name in ((main.CB_LIST, "list"), (main.CB_DELETE_LIST,
+                                                "delete")):
+        latencies = []
+        for i, chat_id in enumerate([largest] + chats[1:samples]):
+            # Холодный кэш: порядок чата и отрисовка считаются заново
+            store._invalidate_chat(chat_id)
+            update = FakeUpdate(chat_id, i, main.button_data(code, 0))
+            started = time.perf_counter()
+            await main.button_handler(update, None)
+            latencies.append(time.perf_counter() - started)
+
+            if i == 0:
+                results.add(count, f"handler_{name}_largest_cold",
+                            latencies[0] * 1e3, "ms")
+                update = FakeUpdate(chat_id, -1, main.button_data(code, 0))
+                started = time.perf_counter()
+                await main.button_handler(update, None)
+                results.add(count, f"handler_{name}_largest_warm",
+                            (time.perf_counter() - started) * 1e3, "ms")
+
+        results.add(count, f"handler_{name}_mean",
+                    statistics.fmean(latencies) * 1e3, "ms")
+        results.add(count, f"handler_{name}_p95",
+                    percentile(latencies, 0.95) * 1e3, "ms")
+
+
+async def bench_size(results, count, args):
+    now = datetime.now(pytz.UTC)
+    chats = args.chats or max(1, count // 20)
+    data = generate_events(count, chats, args.history, args.legacy, args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        write_dataset(main.DATA_FILE, data)
+        del data
+        results.add(count, "dataset_size", os.path.getsize(main.DATA_FILE),
+                    "bytes")
+
+        store_cls = (main.SqliteEventStore
+                     if args.backend == "sqlite" else main.EventStore)
+        store = bench_store(results, count, store_cls)
+        main.store = store
+        main._page_cache.clear()
+        main._rendered.clear()
+        await bench_journal(results, count, store, now)
+        bench_occurrences(results, count, store, now)
+        bench_scheduler(results, count, store, now, args.hours, args.step)
+        await bench_handlers(results, count, store, args.samples)
+        await store.close()
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True,
+                              text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = Results()
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    try:
+        for count in args.events:
+            print(f"📊 {count} events", file=sys.stderr)
+            # Логи бота не должны смешиваться с JSON в stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                asyncio.run(bench_size(results, count, args))
+    finally:
+        os.chdir(cwd)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "legacy": args.legacy,
+            "seed": args.seed,
+            "created_at": datetime.utcnow().isoformat(),
+        },
+        "results": results.rows,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def compare(args):
+    """Сравнить два прогона; код выхода 1 при регрессии сверх порога"""
+    with open(args.old, encoding="utf-8") as f:
+        old = {(r["events"], r["metric"]): r for r in json.load(f)["results"]}
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for row in new:
+        before = old.get((row["events"], row["metric"]))
+        if not before or not before["value"]:
+            continue
+        ratio = row["value"] / before["value"]
+        mark = ""
+        # Сравниваем только время: остальное (строки, размер) не «хуже»
+        if row["unit"] in ("s", "ms", "us") and ratio > args.threshold:
+            mark = "  ⚠️ regression"
+            regressions += 1
+        print(f"{row['events']:>9} {row['metric']:<28} "
+              f"{before['value']:>14.3f} -> {row['value']:>14.3f} "
+              f"{row['unit']:<7} x{ratio:.2f}{mark}")
+    return 1 if regressions else 0
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",")]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="создать events.json")
+    gen.add_argument("--events", type=int, default=10000)
+    gen.add_argument("--chats", type=int, default=0)
+    gen.add_argument("--history", type=int, default=20)
+    gen.add_argument("--legacy", action="store_true")
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("-o", "--output", default=main.DATA_FILE)
+
+    bench = commands.add_parser("run", help="запустить замеры")
+    bench.add_argument("--events", type=parse_sizes, default=[1000, 10000])
+    bench.add_argument("--chats", type=int, default=0)
+    bench.add_argument("--history", type=int, default=20)
+    bench.add_argument("--legacy", action="store_true")
+    bench.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    bench.add_argument("--hours", type=int, default=24)
+    bench.add_argument("--step", type=int, default=60)
+    bench.add_argument("--samples", type=int, default=50)
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("-o", "--output")
+
+    cmp = commands.add_parser("compare", help="сравнить два прогона")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=1.2)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        chats = args.chats or max(1, args.events // 20)
+        write_dataset(
+            args.output,
+            generate_events(args.events, chats, args.history, args.legacy,
+                            args.seed))
+        print(f"✅ {args.events} events in {chats} chats -> {args.output}")
+    elif args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main_cli()
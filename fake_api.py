@@ -0,0 +1,588 @@
+"""Локальная имитация Telegram Bot API для сквозной нагрузки
+
+Сервер отвечает на вызовы, которые делает бот (getMe, setMyCommands,
+deleteWebhook, getUpdates, sendMessage, editMessageText,
+answerCallbackQuery), с настраиваемой задержкой, долей ошибок и 429.
+Драйвер проводит тысячи чатов через создание события
+(/start → «Добавить» → название → дата → «Один раз» → «В момент события»)
+и ждёт напоминаний, измеряя пропускную способность обработчиков
+и опоздание доставки.
+
+Пример (бот запускается в отдельном каталоге автоматически):
+    python fake_api.py --chats 1000 --latency 0.05 --error-rate 0.01 --spawn
+
+Или вручную:
+    python fake_api.py --serve-only --port 8081
+    BOT_API_URL=http://127.0.0.1:8081/bot TELEGRAM_TOKEN=1:fake python main.py
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+import pytz
+
+import main
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Reminder",
+    "username": "fake_reminder_bot",
+}
+
+# Методы, которые не задерживаются и не ломаются намеренно
+SERVICE_METHODS = ("getMe", "getUpdates", "deleteWebhook", "setMyCommands")
+# Методы отправки, на которые действуют лимиты и 429
+SEND_METHODS = ("sendMessage", "editMessageText")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summary(values):
+    """Среднее и перцентили в миллисекундах"""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2),
+        "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+
+# ============= СЕРВЕР =============
+
+
+class FakeBotApi(main.HttpServer):
+    """Bot API в памяти: очередь обновлений и сообщения по чатам"""
+
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.updates = deque()
+        self.next_update_id = 1
+        self.update_added = asyncio.Event()
+        self.polled = asyncio.Event()
+        self.next_message_id = 1
+        # (chat_id, message_id) -> сообщение бота
+        self.messages = {}
+        # chat_id -> очередь (время, сообщение) для драйвера
+        self.inbox = {}
+        self.calls = Counter()
+        self.injected = Counter()
+        # Соблюдение лимитов: время последней отправки в чат и окно секунды
+        self.last_send = {}
+        self.recent_sends = deque()
+        self.methods = {
+            "getMe": self.get_me,
+            "setMyCommands": self.ok_true,
+            "deleteWebhook": self.ok_true,
+            "getUpdates": self.get_updates,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "answerCallbackQuery": self.ok_true,
+        }
+
+    # ----- протокол -----
+
+    @staticmethod
+    def reply(result):
+        body = json.dumps({"ok": True, "result": result}, ensure_ascii=False)
+        return 200, body, "application/json"
+
+    @staticmethod
+    def error(code, description, retry_after=None):
+        payload = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            payload["parameters"] = {"retry_after": retry_after}
+        return code, json.dumps(payload), "application/json"
+
+    @staticmethod
+    def parse_params(request):
+        """Параметры вызова: форма (так шлёт PTB) или JSON"""
+        if not request.body:
+            return {}
+        if request.headers.get("content-type",
+                               "").startswith("application/json"):
+            return json.loads(request.body)
+        params = {}
+        for key, value in parse_qsl(request.body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _respond(self, request):
+        # /bot<token>/<method>
+        parts = request.path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return self.error(404, "Not Found")
+        method = parts[1]
+        handler = self.methods.get(method)
+        self.calls[method] += 1
+        if not handler:
+            return self.error(404, f"Not Found: method {method} not found")
+
+        params = self.parse_params(request)
+        if method not in SERVICE_METHODS:
+            if self.args.latency:
+                await asyncio.sleep(self.args.latency *
+                                    self.rng.uniform(0.5, 1.5))
+            if self.rng.random() < self.args.error_rate:
+                self.injected["502"] += 1
+                return self.error(502, "Bad Gateway")
+            if method in SEND_METHODS:
+                limited = self.check_limits(params.get("chat_id"))
+                if limited:
+                    return limited
+        return await handler(params)
+
+    def check_limits(self, chat_id):
+        """429 по случайности или при превышении заданных лимитов"""
+        if self.rng.random() < self.args.retry_after_rate:
+            self.injected["429"] += 1
+            return self.error(429, "Too Many Requests: retry after 1", 1)
+
+        now = time.monotonic()
+        if self.args.chat_interval:
+            last = self.last_send.get(chat_id, 0)
+            if now - last < self.args.chat_interval:
+                self.injected["429_chat"] += 1
+                return self.error(429, "Too Many Requests: retry after 1", 1)
+            self.last_send[chat_id] = now
+
+        if self.args.global_rate:
+            while self.recent_sends and now - self.recent_sends[0] >= 1:
+                self.recent_sends.popleft()
+            if len(self.recent_sends) >= self.args.global_rate:
+                self.injected["429_global"] += 1
+                return self.error(429, "Too Many Requests: retry after 1", 1)
+            self.recent_sends.append(now)
+        return None
+
+    # ----- методы -----
+
+    async def ok_true(self, params):
+        return self.reply(True)
+
+    async def get_me(self, params):
+        return self.reply(BOT_USER)
+
+    async def get_updates(self, params):
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+
+        if not self.updates:
+            self.update_added.clear()
+            try:
+                await asyncio.wait_for(self.update_added.wait(),
+                                       float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.reply(list(self.updates)[:limit])
+
+    def _message(self, chat_id, text, reply_markup):
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {
+                "id": chat_id,
+                "type": "private" if chat_id > 0 else "group",
+                "first_name": f"user{chat_id}",
+            },
+            "from": BOT_USER,
+            "text": text,
+        }
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        self.next_message_id += 1
+        return message
+
+    def _deliver(self, message):
+        chat_id = message["chat"]["id"]
+        self.messages[(chat_id, message["message_id"])] = message
+        self.inbox.setdefault(chat_id, asyncio.Queue()).put_nowait(
+            (time.time(), message))
+
+    async def send_message(self, params):
+        message = self._message(int(params["chat_id"]), params["text"],
+                                params.get("reply_markup"))
+        self._deliver(message)
+        return self.reply(message)
+
+    async def edit_message_text(self, params):
+        key = (int(params["chat_id"]), int(params["message_id"]))
+        message = self.messages.get(key)
+        if not message:
+            return self.error(400, "Bad Request: message to edit not found")
+        if (message["text"] == params["text"]
+                and message.get("reply_markup") == params.get("reply_markup")):
+            return self.error(400, "Bad Request: message is not modified")
+        message["text"] = params["text"]
+        message.pop("reply_markup", None)
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self._deliver(message)
+        return self.reply(message)
+
+    # ----- подача обновлений -----
+
+    def push_update(self, payload):
+        payload["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(payload)
+        self.update_added.set()
+
+    def user_text(self, chat_id, text):
+        message = self._message(chat_id, text, None)
+        message["from"] = {
+            "id": chat_id,
+            "is_bot": False,
+            "first_name": f"user{chat_id}"
+        }
+        if text.startswith("/"):
+            message["entities"] = [{
+                "type": "bot_command",
+                "offset": 0,
+                "length": len(text.split()[0])
+            }]
+        self.push_update({"message": message})
+
+    def user_click(self, chat_id, message, callback_data):
+        self.push_update({
+            "callback_query": {
+                "id": str(self.next_update_id),
+                "from": {
+                    "id": chat_id,
+                    "is_bot": False,
+                    "first_name": f"user{chat_id}"
+                },
+                "chat_instance": str(chat_id),
+                "message": message,
+                "data": callback_data,
+            }
+        })
+
+
+# ============= ДРАЙВЕР =============
+
+
+class FlowError(Exception):
+    pass
+
+
+class Driver:
+    """Пользователи, создающие события через кнопки"""
+
+    def __init__(self, api, args):
+        self.api = api
+        self.args = args
+        self.step_latency = []
+        self.completed = 0
+        self.failures = Counter()
+        # chat_id -> ожидаемое время напоминания (epoch)
+        self.expected = {}
+        self.lags = []
+        self.flow_started = None
+        self.flow_finished = None
+
+    async def next_message(self, chat_id, predicate):
+        """Ждать сообщение бота в чате, подходящее под predicate"""
+        queue = self.api.inbox.setdefault(chat_id, asyncio.Queue())
+        deadline = time.monotonic() + self.args.step_timeout
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise FlowError("timeout")
+            try:
+                received_at, message = await asyncio.wait_for(
+                    queue.get(), timeout)
+            except asyncio.TimeoutError:
+                raise FlowError("timeout")
+            if predicate(message):
+                return received_at, message
+
+    @staticmethod
+    def button(message, label):
+        """callback_data кнопки, в тексте которой есть label"""
+        keyboard = (message.get("reply_markup") or {}).get("inline_keyboard")
+        for row in keyboard or []:
+            for button in row:
+                if label in button["text"]:
+                    return button["callback_data"]
+        return None
+
+    def has_button(self, label):
+        return lambda message: self.button(message, label) is not None
+
+    async def step(self, name, chat_id, action, predicate):
+        """Действие пользователя и ожидание ответа бота"""
+        started = time.time()
+        action()
+        try:
+            received_at, message = await self.next_message(chat_id, predicate)
+        except FlowError as e:
+            raise FlowError(f"{e}:{name}")
+        self.step_latency.append(received_at - started)
+        return message
+
+    def text(self, chat_id, text):
+        return lambda: self.api.user_text(chat_id, text)
+
+    def click(self, chat_id, message, label):
+        return lambda: self.api.user_click(chat_id, message,
+                                           self.button(message, label))
+
+    @staticmethod
+    def contains(text):
+        return lambda message: text in message["text"]
+
+    async def flow(self, chat_id, event_at):
+        date = datetime.fromtimestamp(event_at, pytz.UTC).astimezone(
+            main.TIMEZONE).strftime("%Y-%m-%d %H:%M")
+        try:
+            menu = await self.step("start", chat_id,
+                                   self.text(chat_id, "/start"),
+                                   self.has_button("Добавить"))
+            await self.step("add", chat_id,
+                            self.click(chat_id, menu, "Добавить"),
+                            self.contains("Шаг 1/4"))
+            await self.step("title", chat_id,
+                            self.text(chat_id, f"Нагрузка {chat_id}"),
+                            self.contains("Шаг 2/4"))
+            repeat = await self.step("date", chat_id, self.text(chat_id, date),
+                                     self.has_button("Один раз"))
+            notify = await self.step("repeat", chat_id,
+                                     self.click(chat_id, repeat, "Один раз"),
+                                     self.has_button("В момент события"))
+            await self.step("notify", chat_id,
+                            self.click(chat_id, notify, "В момент события"),
+                            self.contains("Событие создано"))
+        except FlowError as e:
+            self.failures[str(e)] += 1
+            return
+        self.completed += 1
+        self.expected[chat_id] = event_at
+
+    async def await_reminder(self, chat_id, event_at, deadline):
+        queue = self.api.inbox.setdefault(chat_id, asyncio.Queue())
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return
+            try:
+                received_at, message = await asyncio.wait_for(
+                    queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return
+            if "Событие началось" in message["text"]:
+                self.lags.append(received_at - event_at)
+                return
+
+    async def run(self):
+        args = self.args
+        await self.api.polled.wait()
+        self.flow_started = time.time()
+
+        # События назначаются на целые минуты (дата вводится с точностью
+        # до минуты) и распределяются по spread минутам
+        first = math.ceil((self.flow_started + args.lead) / 60) * 60
+        chat_ids = [100000 + i for i in range(args.chats)]
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def limited(chat_id, event_at):
+            async with limit:
+                await self.flow(chat_id, event_at)
+
+        await asyncio.gather(*[
+            limited(chat_id, first + 60 * (i % max(args.spread, 1)))
+            for i, chat_id in enumerate(chat_ids)
+        ])
+        self.flow_finished = time.time()
+        print(
+            f"🧪 Flows done: {self.completed}/{args.chats} in "
+            f"{self.flow_finished - self.flow_started:.1f} s",
+            file=sys.stderr)
+
+        late = [t for t in self.expected.values() if t < self.flow_finished]
+        if late:
+            print(
+                f"⚠️ {len(late)} events were created after their time; "
+                "increase --lead",
+                file=sys.stderr)
+
+        deadline = max(self.expected.values(), default=0) + args.wait
+        await asyncio.gather(*[
+            self.await_reminder(chat_id, event_at, deadline)
+            for chat_id, event_at in self.expected.items()
+        ])
+
+    def report(self):
+        flow_time = (self.flow_finished or time.time()) - self.flow_started
+        return {
+            "chats":
+            self.args.chats,
+            "flows_completed":
+            self.completed,
+            "flow_failures":
+            dict(self.failures),
+            "flow_seconds":
+            round(flow_time, 3),
+            "handler_throughput_per_s":
+            round(len(self.step_latency) / flow_time, 2) if flow_time else 0,
+            "handler_latency":
+            summary(self.step_latency),
+            "reminders_expected":
+            len(self.expected),
+            "reminders_received":
+            len(self.lags),
+            "delivery_lag":
+            summary(self.lags),
+            "api_calls":
+            dict(self.api.calls),
+            "injected_errors":
+            dict(self.api.injected),
+        }
+
+
+# ============= ЗАПУСК =============
+
+
+def spawn_bot(args):
+    """Запустить main.py в отдельном каталоге против локального API"""
+    workdir = tempfile.mkdtemp(prefix="fake-api-")
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    env = dict(os.environ,
+               TELEGRAM_TOKEN="123456:FAKE",
+               BOT_API_URL=f"http://127.0.0.1:{args.port}/bot",
+               BOT_MODE="polling",
+               PYTHONUNBUFFERED="1")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "main.py")
+    process = subprocess.Popen([sys.executable, script],
+                               cwd=workdir,
+                               env=env,
+                               stdout=log,
+                               stderr=subprocess.STDOUT)
+    print(f"🤖 Bot spawned (pid {process.pid}), log: {log.name}",
+          file=sys.stderr)
+    return process
+
+
+async def drive(args):
+    """Сервер, бот и драйвер; результат — отчёт драйвера"""
+    api = FakeBotApi(args)
+    await api.start("127.0.0.1", args.port)
+    if args.serve_only:
+        await asyncio.Event().wait()
+
+    process = spawn_bot(args) if args.spawn else None
+    driver = Driver(api, args)
+    try:
+        await driver.run()
+    finally:
+        if process:
+            process.send_signal(signal.SIGINT)
+            await asyncio.get_running_loop().run_in_executor(
+                None, process.wait)
+        await api.close()
+    return driver.report()
+
+
+def run(args):
+    # В stdout — только JSON отчёт, служебные сообщения уходят в stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(drive(args))
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=200,
+                        help="сколько чатов проходят сценарий одновременно")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.0,
+                        help="средняя задержка ответа API (секунды)")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0.0,
+                        help="доля ответов 502")
+    parser.add_argument("--retry-after-rate",
+                        type=float,
+                        default=0.0,
+                        help="доля случайных ответов 429")
+    parser.add_argument("--chat-interval",
+                        type=float,
+                        default=0.0,
+                        help="429, если в чат пишут чаще (секунды)")
+    parser.add_argument("--global-rate",
+                        type=int,
+                        default=0,
+                        help="429 сверх стольких отправок в секунду")
+    parser.add_argument("--lead",
+                        type=int,
+                        default=90,
+                        help="через сколько секунд после старта события")
+    parser.add_argument("--spread",
+                        type=int,
+                        default=1,
+                        help="на сколько минут распределить события")
+    parser.add_argument("--wait",
+                        type=int,
+                        default=120,
+                        help="сколько ждать напоминаний после события")
+    parser.add_argument("--step-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--spawn",
+                        action="store_true",
+                        help="запустить бота автоматически")
+    parser.add_argument("--serve-only",
+                        action="store_true",
+                        help="только сервер, без драйвера")
+    parser.add_argument("-o", "--output")
+    args = parser.parse_args()
+
+    try:
+        run(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,33 +1,1075 @@
+import gzip
+import hmac
 import json
 import uuid
 import os
+import sqlite3
 from datetime import datetime, timedelta
 import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import calendar
+import functools
+import heapq
+import random
+import secrets
+import signal
+import sys
+import threading
+import time
 import pytz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import (Application, CommandHandler, CallbackQueryHandler,
-                          MessageHandler, ContextTypes, filters)
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler,
+                          CallbackQueryHandler, MessageHandler, ContextTypes,
+                          filters)
 
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
+# Адрес Bot API (например, локальный сервер из fake_api.py для нагрузки)
+BOT_API_URL = os.environ.get("BOT_API_URL", "")
 DATA_FILE = "events.json"
+DB_FILE = "events.db"
+ARCHIVE_DIR = "archive"
+
+# Хранилище: json (events.json + журнал) или sqlite (events.db)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
 
 # Часовой пояс Москва
 TIMEZONE = pytz.timezone("Europe/Moscow")
 
+# Задержка группового коммита журнала (секунды)
+FLUSH_DELAY = float(os.environ.get("FLUSH_DELAY", "2"))
+# Сколько записей журнала копить до сжатия в снимок
+JOURNAL_COMPACT_RECORDS = int(os.environ.get("JOURNAL_COMPACT_RECORDS",
+                                             "1000"))
+# Как часто (секунды) сохранять watermark. После перезапуска это окно
+# проходится заново, но доставленные напоминания там уже отмечены
+WATERMARK_SAVE_INTERVAL = float(
+    os.environ.get("WATERMARK_SAVE_INTERVAL", "300"))
+
+# Конец первой строки снимка: дальше идут события, по одному на строку
+SNAPSHOT_EVENTS = '"events":[\n'
+SNAPSHOT_END = "\n]}\n"
+
+
+def dump_event(event):
+    """Сериализация события: неизменяемая копия для потока записи"""
+    return json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_data(path=DATA_FILE):
+    """Прочитать снимок: (служебные поля, [(событие, его JSON строка)])
 
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {"events": []}
+    Строки событий снимка переиспользуются как готовая сериализация.
+    У снимков старого вида (одной строкой) строк нет — вместо них None.
+    """
+    if not os.path.exists(path):
+        return {}, []
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "r", encoding="utf-8") as f:
+            head = f.readline()
+            if not head.endswith(SNAPSHOT_EVENTS):
+                f.seek(0)
+                data = json.load(f)
+                return data, [(event, None)
+                              for event in data.pop("events", [])]
+
+            data = json.loads(head[:-len(SNAPSHOT_EVENTS)].rstrip(",") + "}")
+            body = f.read()
+            if not body.endswith(SNAPSHOT_END):
+                raise ValueError("snapshot is truncated")
+            body = body[:-len(SNAPSHOT_END)]
+            if not body:
+                return data, []
+            # Один разбор на весь снимок, строки событий — его же куски
+            return data, list(zip(json.loads(f"[{body}]"), body.split(",\n")))
     except:
-        return {"events": []}
+        return {}, []
+
+
+def save_data(meta, events, path=DATA_FILE):
+    """Записать снимок: служебные поля (JSON) и строки событий"""
+    # Пишем во временный файл и атомарно подменяем, чтобы не потерять данные
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(meta[:-1] + ("," if meta != "{}" else "") + SNAPSHOT_EVENTS)
+        f.write(",\n".join(events))
+        f.write(SNAPSHOT_END)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_journal(path):
+    """Прочитать записи журнала, пропуская недописанный хвост"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"⚠️ Skipping broken journal record in {path}")
+                break
+    return records
+
+
+def append_journal(records, path):
+    """Дописать записи в журнал одним fsync (групповой коммит)"""
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(
+                json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# ============= МЕТРИКИ =============
+
+# Адрес страницы /metrics (порт 0 — не запускать)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+# Пользователи, которым /debug показывает метрики (id через запятую)
+ADMIN_IDS = {
+    int(user_id)
+    for user_id in os.environ.get("ADMIN_IDS", "").split(",")
+    if user_id.strip()
+}
+
+# Границы корзин гистограмм (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Counter:
+    """Монотонный счётчик с метками"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        if not self.values:
+            return [f"{self.name} 0"]
+        return [
+            f"{self.name}{_format_labels(key)} {value}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Gauge:
+    """Текущее значение; read — функция, если значение считается на лету"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read=None):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.read() if self.read else self.value
+
+    def render(self):
+        return [f"{self.name} {self.get()}"]
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, как в Prometheus"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        # метки -> [счётчики корзин и +Inf, сумма]
+        self.values = {}
+
+    def _entry(self, labels):
+        return self.values.get(tuple(sorted(labels.items())))
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        entry[1] += value
+
+    def count(self, **labels):
+        entry = self._entry(labels)
+        return sum(entry[0]) if entry else 0
+
+    def mean(self, **labels):
+        count = self.count(**labels)
+        return self._entry(labels)[1] / count if count else 0.0
+
+    def quantile(self, q, **labels):
+        """Оценка квантиля по корзинам (линейно внутри корзины)"""
+        count = self.count(**labels)
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for bound, bucket in zip(self.buckets, self._entry(labels)[0]):
+            if bucket and seen + bucket >= rank:
+                return lower + (bound - lower) * (rank - seen) / bucket
+            seen += bucket
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket"
+                             f"{_format_labels(key, ('le', bound))} "
+                             f"{cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket"
+                         f"{_format_labels(key, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} "
+                         f"{cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Все метрики бота и их выдача в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+TICK_SECONDS = metrics.add(
+    Histogram("reminder_tick_seconds", "Duration of a scheduler tick"))
+DUE_ITEMS = metrics.add(
+    Gauge("reminder_due_items", "Reminders popped by the last tick"))
+SEND_SECONDS = metrics.add(
+    Histogram("telegram_send_seconds", "Latency of sendMessage for reminders"))
+SEND_FAILURES = metrics.add(
+    Counter("telegram_send_failures_total", "Failed reminder sends by reason"))
+REMINDERS_SENT = metrics.add(
+    Counter("reminders_sent_total", "Reminders delivered"))
+DELIVERY_LAG = metrics.add(
+    Histogram("reminder_delivery_lag_seconds",
+              "Delay between scheduled and actual delivery", LAG_BUCKETS))
+CALLBACK_SECONDS = metrics.add(
+    Histogram("callback_handler_seconds", "Button handler latency by route"))
+STORE_LOAD_SECONDS = metrics.add(
+    Gauge("store_load_seconds", "Duration of the startup store load"))
+STORE_WRITE_SECONDS = metrics.add(
+    Histogram("store_write_seconds",
+              "Duration of a store write batch (journal or snapshot)"))
+LOOP_LAG = metrics.add(
+    Histogram("event_loop_lag_seconds", "Event loop scheduling delay"))
+TASK_RESTARTS = metrics.add(
+    Counter("background_task_restarts_total",
+            "Background task restarts after a crash or exit"))
+# Метрики, значения которых читаются из объектов бота
+metrics.add(
+    Gauge("reminder_queue_rows", "Rows in the reminder table",
+          lambda: len(scheduler)))
+metrics.add(
+    Gauge("retry_queue_size", "Reminders waiting for a retry",
+          lambda: len(delivery_queue)))
+metrics.add(Gauge("events", "Stored events", lambda: len(store.events)))
+
+# Период замера задержки event loop (секунды)
+LOOP_LAG_INTERVAL = 1.0
+
+
+async def measure_loop_lag():
+    """Замер задержки event loop: на сколько позже просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(loop.time() - started - LOOP_LAG_INTERVAL, 0)
+        LOOP_LAG.observe(lag)
+        health.loop_tick(lag)
+
+
+async def metrics_request(request):
+    return 200, metrics.render(), "text/plain; version=0.0.4"
+
+
+# ============= ХРАНИЛИЩЕ =============
+
+# Версия формата данных:
+# 1 — event_time строкой ISO, sent_notifications списком ключей
+# 2 — event_at в epoch-секундах, delivered по каждому напоминанию
+SCHEMA_VERSION = 2
 
+# Сколько разобранных времён событий держать в кэше
+EVENT_DATETIME_CACHE_SIZE = 65536
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+
+@functools.lru_cache(maxsize=EVENT_DATETIME_CACHE_SIZE)
+def _utc_datetime(at):
+    """epoch -> datetime (UTC); кэш ограничен, удалённые события вытесняются"""
+    return datetime.fromtimestamp(at, pytz.UTC)
+
+
+def event_datetime(event):
+    """Время события как datetime в UTC (без разбора строк)"""
+    at = event.get("event_at")
+    if at is None:
+        return None
+    return _utc_datetime(at)
+
+
+def normalize_event(event):
+    """Привести событие из старого формата к текущему (на месте)"""
+    if "event_time" in event:
+        event_dt = parse_event_time(event.pop("event_time"))
+        if event_dt is not None:
+            event["event_at"] = int(event_dt.timestamp())
+    if "sent_notifications" in event:
+        # Список "<iso>_<minutes>" -> последнее доставленное повторение
+        # для каждого напоминания (epoch-секунды)
+        delivered = event.setdefault("delivered", {})
+        for key in event.pop("sent_notifications"):
+            try:
+                iso, minutes = key.rsplit("_", 1)
+                at = int(parse_event_time(iso).timestamp())
+            except Exception:
+                continue
+            if at > delivered.get(minutes, 0):
+                delivered[minutes] = at
+    event.setdefault("delivered", {})
+    return event
+
+
+class EventStore:
+    """Хранилище событий в памяти с журналом изменений на диске
+
+    Снимок лежит в events.json, изменения (создание, удаление, отметка
+    отправки) дописываются в events.json.journal групповыми коммитами.
+    Когда журнал разрастается, он сворачивается в новый снимок.
+    """
+
+    def __init__(self, path=DATA_FILE, flush_delay=FLUSH_DELAY):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.flush_delay = flush_delay
+        # Служебные поля файла (всё, кроме списка событий)
+        self.data = {}
+        # Индексы: id -> событие и chat_id -> {id: событие}
+        self._by_id = {}
+        self._by_chat = {}
+        # id -> JSON строка события; обновляется при каждом изменении,
+        # поэтому снимок собирается без копирования самих событий
+        self._json = {}
+        # Кэш порядка событий чата: chat_id -> (valid_until, [(event, next_dt)])
+        self._chat_order = {}
+        # Ревизия порядка чата: меняется при любом его пересчёте
+        self._chat_revision = {}
+        # Записи журнала, ожидающие группового коммита
+        self._pending = []
+        self._journal_records = 0
+        self._needs_snapshot = False
+        # Последний записанный на диск watermark
+        self._saved_watermark = 0
+        self._flush_task = None
+        # Единственный поток записи на диск
+        self._io = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix="store-io")
+
+    def load(self):
+        """Однократная загрузка данных при старте"""
+        data, events = load_data(self.path)
+        self.data = data
+        self._by_id = {}
+        self._by_chat = {}
+        self._json = {}
+        self._chat_order = {}
+        outdated = data.get("version", 1) < SCHEMA_VERSION
+        self.data["version"] = SCHEMA_VERSION
+        for event, raw in events:
+            # События старого формата меняются при разборе
+            self._index(event, None if outdated else raw)
+
+        # Восстановление: снимок + хвост журнала
+        records = load_journal(self.journal_path)
+        for record in records:
+            self._replay(record)
+        print(f"📂 Loaded {len(self._by_id)} events from {self.path} "
+              f"(+{len(records)} journal records)")
+        if records or outdated:
+            self.compact()
+
+    def snapshot(self):
+        """Снимок для записи в другом потоке: (служебные поля, строки событий)
+
+        Только неизменяемые строки: event loop может менять данные,
+        пока поток записи сохраняет снимок.
+        """
+        return (json.dumps(self.data,
+                           ensure_ascii=False,
+                           separators=(",", ":")), list(self._json.values()))
+
+    def _replay(self, record):
+        op = record.get("op")
+        if op == "add":
+            self._index(record["event"])
+        elif op == "delete":
+            self._unindex(record["id"])
+        elif op == "move":
+            event = self._unindex(record["id"])
+            if event:
+                event["chat_id"] = record["chat_id"]
+                self._index(event)
+        elif op == "sent":
+            # Запись старого формата со списком ключей
+            event = self._by_id.get(record["id"])
+            if event:
+                event["sent_notifications"] = record["sent"]
+                normalize_event(event)
+                self._touch(event)
+        elif op == "delivered":
+            event = self._by_id.get(record["id"])
+            if event:
+                event["delivered"][record["minutes"]] = record["at"]
+                self._touch(event)
+        elif op == "retry":
+            self.data.setdefault("outbox",
+                                 {})[record["entry"]["key"]] = record["entry"]
+        elif op == "retry_done":
+            self.data.get("outbox", {}).pop(record["key"], None)
+        elif op == "watermark":
+            self.data["watermark"] = record["at"]
+
+    def _index(self, event, raw=None):
+        normalize_event(event)
+        self._by_id[event["id"]] = event
+        self._by_chat.setdefault(event["chat_id"], {})[event["id"]] = event
+        self._json[event["id"]] = raw if raw is not None else dump_event(event)
+        self._invalidate_chat(event["chat_id"])
+
+    def _touch(self, event):
+        """Событие изменилось на месте: обновить его JSON строку"""
+        self._json[event["id"]] = dump_event(event)
+
+    def _invalidate_chat(self, chat_id):
+        self._chat_order.pop(chat_id, None)
+        self._chat_revision[chat_id] = self._chat_revision.get(chat_id, 0) + 1
+
+    def chat_revision(self, chat_id):
+        """Ревизия событий чата для кэшей отрисовки"""
+        return self._chat_revision.get(chat_id, 0)
+
+    @property
+    def events(self):
+        return self._by_id.values()
+
+    def chat_events(self, chat_id, now=None):
+        """События чата по возрастанию следующего повторения: [(event, next_dt)]
+
+        Прошедшие разовые события (next_dt is None) идут в конце.
+        Порядок кэшируется до ближайшего повторения в чате.
+        """
+        if now is None:
+            now = datetime.now(pytz.UTC)
+
+        cached = self._chat_order.get(chat_id)
+        if cached and (cached[0] is None or now < cached[0]):
+            return cached[1]
+
+        events = self._by_chat.get(chat_id, {})
+        occurrences = get_next_occurrences(
+            (event_datetime(e), e.get("repeat", "once"), now)
+            for e in events.values())
+        order = sorted(zip(events.values(), occurrences),
+                       key=lambda pair: (pair[1] is None, pair[1] or now))
+        valid_until = min((o for o in occurrences if o), default=None)
+        self._invalidate_chat(chat_id)
+        self._chat_order[chat_id] = (valid_until, order)
+        return order
+
+    def get(self, event_id):
+        return self._by_id.get(event_id)
+
+    def add(self, event):
+        self._index(event)
+        # Запись журнала — отдельная копия: событие ещё будет меняться
+        self._log({"op": "add", "event": json.loads(self._json[event["id"]])})
+
+    def _unindex(self, event_id):
+        event = self._by_id.pop(event_id, None)
+        self._json.pop(event_id, None)
+        if event:
+            chat = self._by_chat.get(event["chat_id"], {})
+            chat.pop(event_id, None)
+            if not chat:
+                self._by_chat.pop(event["chat_id"], None)
+            self._invalidate_chat(event["chat_id"])
+        return event
+
+    def delete(self, event_id):
+        """Удалить событие, вернуть его или None"""
+        event = self._unindex(event_id)
+        if event:
+            self._log({"op": "delete", "id": event_id})
+        return event
+
+    def migrate_chat(self, old_chat_id, new_chat_id):
+        """Перенести события чата на новый id (группа стала супергруппой)
+
+        Повторы ссылаются на событие, а не на чат, поэтому уходят
+        на новый id вместе с ним. Возвращает число перенесённых событий.
+        """
+        moved = list(self._by_chat.get(old_chat_id, {}).values())
+        for event in moved:
+            self._unindex(event["id"])
+            event["chat_id"] = new_chat_id
+            self._index(event)
+            self._log({
+                "op": "move",
+                "id": event["id"],
+                "chat_id": new_chat_id
+            })
+        if self.is_parked(old_chat_id):
+            self.unpark_chat(old_chat_id)
+        return len(moved)
+
+    def mark_delivered(self, event, minutes, occurrence):
+        """Отметить напоминание за minutes до occurrence доставленным"""
+        at = int(occurrence.timestamp())
+        event["delivered"][str(minutes)] = at
+        self._touch(event)
+        self._log({
+            "op": "delivered",
+            "id": event["id"],
+            "minutes": str(minutes),
+            "at": at
+        })
+
+    def retries(self):
+        """Напоминания, ожидающие повторной отправки"""
+        return list(self.data.get("outbox", {}).values())
+
+    def put_retry(self, entry):
+        self.data.setdefault("outbox", {})[entry["key"]] = entry
+        self._log({"op": "retry", "entry": dict(entry)})
+
+    def drop_retry(self, key):
+        if self.data.get("outbox", {}).pop(key, None):
+            self._log({"op": "retry_done", "key": key})
+
+    @property
+    def watermark(self):
+        """До какого момента (epoch) напоминания переданы в отправку"""
+        return self.data.get("watermark")
+
+    def set_watermark(self, at):
+        """Сдвинуть watermark; на диск он пишется не чаще интервала"""
+        at = int(at)
+        if at > (self.data.get("watermark") or 0):
+            self.data["watermark"] = at
+            if at - self._saved_watermark >= WATERMARK_SAVE_INTERVAL:
+                self.save_watermark()
+
+    def save_watermark(self):
+        at = self.data.get("watermark")
+        if at and at > self._saved_watermark:
+            self._saved_watermark = at
+            self._log({"op": "watermark", "at": at})
+
+    def is_parked(self, chat_id):
+        return str(chat_id) in self.data.get("parked_chats", {})
+
+    def park_chat(self, chat_id, reason):
+        """Перестать слать в чат, который недоступен (бот удалён и т.п.)"""
+        self.data.setdefault("parked_chats", {})[str(chat_id)] = reason
+        self.mark_dirty()
+
+    def unpark_chat(self, chat_id):
+        if self.data.get("parked_chats", {}).pop(str(chat_id), None):
+            self.mark_dirty()
+
+    def mark_dirty(self):
+        """Пометить данные изменёнными: при следующей записи будет снимок"""
+        self._needs_snapshot = True
+        self._schedule_flush()
+
+    def _log(self, record):
+        self._pending.append(record)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, миграции) пишем сразу
+            self.flush()
+            return
+        self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        try:
+            await asyncio.sleep(self.flush_delay)
+        except asyncio.CancelledError:
+            # Отмена только сокращает ожидание: запись всё равно выполняется
+            pass
+        await self.flush_async()
+
+    def _take_batch(self):
+        """Забрать накопленные изменения (в потоке event loop)"""
+        records, self._pending = self._pending, []
+        snapshot = None
+        if (self._needs_snapshot or self._journal_records + len(records)
+                >= JOURNAL_COMPACT_RECORDS):
+            snapshot = self.snapshot()
+            self._needs_snapshot = False
+        if not records and snapshot is None:
+            return None
+        return records, snapshot
+
+    def _write_batch(self, batch):
+        """Записать пачку на диск (в потоке ввода-вывода)"""
+        records, snapshot = batch
+        try:
+            if snapshot is not None:
+                save_data(*snapshot, self.path)
+                # Снимок уже содержит всё из журнала; повторное применение
+                # журнала к снимку безопасно, поэтому обрезаем после записи
+                with open(self.journal_path, "w", encoding="utf-8"):
+                    pass
+            else:
+                append_journal(records, self.journal_path)
+        except Exception as e:
+            return e
+        return None
+
+    def _finish_batch(self, batch, error):
+        records, snapshot = batch
+        if error:
+            print(f"❌ Error writing {self.path}: {error}")
+            self._pending = records + self._pending
+            self._needs_snapshot = self._needs_snapshot or snapshot is not None
+        elif snapshot is not None:
+            self._journal_records = 0
+        else:
+            self._journal_records += len(records)
+
+    def flush(self):
+        """Синхронная запись изменений (вне event loop)"""
+        batch = self._take_batch()
+        if batch:
+            started = time.perf_counter()
+            error = self._write_batch(batch)
+            STORE_WRITE_SECONDS.observe(time.perf_counter() - started)
+            self._finish_batch(batch, error)
+
+    async def flush_async(self):
+        """Групповой коммит в единственном потоке записи
+
+        Сериализация и fsync выполняются вне event loop, обработчики
+        лишь ждут future; пачки пишутся строго в порядке постановки.
+        """
+        batch = self._take_batch()
+        if not batch:
+            return
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        error = await loop.run_in_executor(self._io, self._write_batch, batch)
+        STORE_WRITE_SECONDS.observe(time.perf_counter() - started)
+        self._finish_batch(batch, error)
+
+    def compact(self):
+        """Свернуть журнал в компактный снимок"""
+        self._needs_snapshot = True
+        self.flush()
+
+    async def run_io(self, func, *args):
+        """Выполнить func в потоке записи, после уже поставленных пачек"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io, func, *args)
+
+    async def close(self):
+        """Принудительная запись при остановке"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        self.save_watermark()
+        await self.flush_async()
+        self._io.shutdown(wait=True)
+
+
+# Записи журнала, которые меняют не события, а служебные поля данных
+META_OPS = ("retry", "retry_done", "watermark")
+
+
+class SqliteEventStore(EventStore):
+    """Хранилище событий в SQLite (WAL)
+
+    База служит только для сохранности: события, планировщик и списки
+    чатов работают из памяти, а изменения групповыми транзакциями
+    пишутся в базу вместо журнала и снимков events.json.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS events ("
+        " id TEXT PRIMARY KEY,"
+        " chat_id INTEGER NOT NULL,"
+        " body TEXT NOT NULL)",
+        # Запросов к базе, кроме загрузки, нет: индексы первых версий
+        # (по чату и по времени напоминания) только замедляли запись.
+        # Колонка next_fire_at в таких базах остаётся пустой
+        "DROP INDEX IF EXISTS idx_events_chat_id",
+        "DROP INDEX IF EXISTS idx_events_next_fire_at",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self,
+                 path=DB_FILE,
+                 flush_delay=FLUSH_DELAY,
+                 json_path=DATA_FILE):
+        super().__init__(path, flush_delay)
+        self.json_path = json_path
+        # Соединение живёт в потоке ввода-вывода
+        self._db = None
+
+    def load(self):
+        """Открыть базу, при первом запуске импортировать events.json"""
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+
+        self.data = {
+            key: json.loads(value)
+            for key, value in self._db.execute("SELECT key, value FROM meta")
+        }
+        self._by_id = {}
+        self._by_chat = {}
+        self._json = {}
+        self._chat_order = {}
+        outdated = self.data.get("version", 1) < SCHEMA_VERSION
+        for (body, ) in self._db.execute("SELECT body FROM events"):
+            self._index(json.loads(body), None if outdated else body)
+
+        if "migrated_from" not in self.data:
+            self.migrate_json()
+        elif self.data.get("version", 1) < SCHEMA_VERSION:
+            # Тела событий перезаписываются в актуальном формате
+            self.rewrite_events()
+            self.data["version"] = SCHEMA_VERSION
+            self._write_meta()
+        print(f"📂 Loaded {len(self._by_id)} events from {self.path}")
+
+    def migrate_json(self):
+        """Однократный импорт events.json (вместе с журналом) в SQLite"""
+        source = EventStore(self.json_path)
+        if os.path.exists(self.json_path):
+            source.load()
+        for event in source.events:
+            self._index(event, source._json[event["id"]])
+        self.data = {
+            **source.data,
+            **self.data, "migrated_from": self.json_path,
+            "version": SCHEMA_VERSION
+        }
+        self.rewrite_events()
+        self._write_meta()
+        print(f"📦 Migrated {len(source._by_id)} events from "
+              f"{self.json_path} to {self.path}")
+
+    def rewrite_events(self):
+        """Перезаписать все события из памяти"""
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO events (id, chat_id, body)"
+                " VALUES (?, ?, ?)",
+                [self._row(event) for event in self._by_id.values()])
+
+    def _row(self, event):
+        return event["id"], event["chat_id"], self._json[event["id"]]
+
+    def _write_meta(self):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False))
+                 for key, value in self.data.items()])
+
+    def _take_batch(self):
+        """Подготовить строки для записи (в потоке event loop)"""
+        records, self._pending = self._pending, []
+        meta = None
+        # Очередь повторов и watermark хранятся в meta вместе с прочими полями
+        if self._needs_snapshot or any(r["op"] in META_OPS for r in records):
+            meta = [(key, json.dumps(value, ensure_ascii=False))
+                    for key, value in self.data.items()]
+            self._needs_snapshot = False
+        if not records and meta is None:
+            return None
+
+        rows = []
+        for record in records:
+            if record["op"] in META_OPS:
+                continue
+            event_id = (record["event"]["id"]
+                        if record["op"] == "add" else record["id"])
+            event = self._by_id.get(event_id)
+            if record["op"] == "delete" or not event:
+                rows.append((event_id, None))
+            else:
+                rows.append((event_id, self._row(event)))
+        return records, meta, rows
+
+    def _write_batch(self, batch):
+        """Одна транзакция на пачку (в потоке ввода-вывода)"""
+        records, meta, rows = batch
+        try:
+            with self._db:
+                for event_id, row in rows:
+                    if row is None:
+                        self._db.execute("DELETE FROM events WHERE id = ?",
+                                         (event_id, ))
+                    else:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO events"
+                            " (id, chat_id, body) VALUES (?, ?, ?)", row)
+                if meta is not None:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO meta (key, value)"
+                        " VALUES (?, ?)", meta)
+        except Exception as e:
+            return e
+        return None
+
+    def _finish_batch(self, batch, error):
+        records, meta, rows = batch
+        if error:
+            print(f"❌ Error writing {self.path}: {error}")
+            self._pending = records + self._pending
+            self._needs_snapshot = self._needs_snapshot or meta is not None
+
+    def _checkpoint(self):
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._db.close()
+
+    def compact(self):
+        """Записать изменения (WAL переносится в базу при остановке)"""
+        self.flush()
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        self.save_watermark()
+        await self.flush_async()
+        if self._db:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._io, self._checkpoint)
+            self._db = None
+        self._io.shutdown(wait=True)
+
+
+def create_store():
+    """Хранилище согласно STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteEventStore()
+    return EventStore()
+
+
+store = create_store()
+
+# ============= КНОПКИ =============
+
+# Коды действий в callback_data (лимит Telegram — 64 байта)
+CB_MAIN_MENU = "m"
+CB_HELP = "h"
+CB_CANCEL = "c"
+CB_ADD_EVENT = "a"
+CB_LIST = "l"
+CB_DELETE_LIST = "d"
+CB_DELETE = "x"
+CB_REPEAT = "r"
+CB_NOTIFY = "n"
+CB_NOTIFY_CUSTOM = "nc"
+
+# Разделитель кода и аргументов
+CALLBACK_SEPARATOR = ":"
+
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# Кнопки старого формата, оставшиеся в уже отправленных сообщениях
+LEGACY_CALLBACKS = {
+    "main_menu": CB_MAIN_MENU,
+    "help": CB_HELP,
+    "cancel": CB_CANCEL,
+    "add_event": CB_ADD_EVENT,
+    "list_events": CB_LIST,
+    "delete_event": CB_DELETE_LIST,
+    "notify_custom": CB_NOTIFY_CUSTOM,
+}
+LEGACY_CALLBACK_PREFIXES = (
+    ("listpage_", CB_LIST),
+    ("delpage_", CB_DELETE_LIST),
+    ("repeat_", CB_REPEAT),
+    ("notify_", CB_NOTIFY),
+    ("del_", CB_DELETE),
+)
+
+
+def short_id(event_id):
+    """Короткая запись id события: UUID в base62 (22 символа)"""
+    try:
+        number = uuid.UUID(event_id).int
+    except ValueError:
+        return "~" + event_id
+
+    digits = []
+    while number:
+        number, digit = divmod(number, 62)
+        digits.append(BASE62[digit])
+    return "".join(reversed(digits)) or "0"
+
+
+def full_id(value):
+    """Исходный id события по короткой записи"""
+    if value.startswith("~"):
+        return value[1:]
+    if "-" in value:  # id из кнопки старого формата
+        return value
+
+    number = 0
+    for char in value:
+        number = number * 62 + BASE62.index(char)
+    return str(uuid.UUID(int=number))
+
+
+def button_data(code, *args):
+    """callback_data для кнопки: код действия и аргументы"""
+    return CALLBACK_SEPARATOR.join((code, *map(str, args)))
+
+
+def parse_callback(data):
+    """Код действия и сырые аргументы из callback_data"""
+    if data in LEGACY_CALLBACKS:
+        return LEGACY_CALLBACKS[data], []
+    for prefix, code in LEGACY_CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return code, [data[len(prefix):]]
+
+    code, *args = data.split(CALLBACK_SEPARATOR)
+    return code, args
+
+
+# ============= ОТРИСОВКА =============
+
+# Сколько последних экранов помнить для пропуска пустых правок
+RENDER_CACHE_SIZE = 10000
+
+# Последний показанный экран: (chat_id, message_id) -> (текст, кнопки)
+_rendered = OrderedDict()
+
+# Ошибки правки, после которых нужно новое сообщение
+_EDIT_FALLBACK_ERRORS = (
+    "message can't be edited",
+    "message to edit not found",
+    "there is no text in the message to edit",
+)
+
+
+def _remember_screen(message, text, reply_markup):
+    key = (message.chat_id, message.message_id)
+    _rendered[key] = (text, reply_markup.to_json() if reply_markup else None)
+    _rendered.move_to_end(key)
+    if len(_rendered) > RENDER_CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+
+async def reply_screen(message, text, reply_markup=None, parse_mode=None):
+    """Отправить новый экран ответом и запомнить его содержимое"""
+    sent = await message.reply_text(text,
+                                    reply_markup=reply_markup,
+                                    parse_mode=parse_mode)
+    _remember_screen(sent, text, reply_markup)
+    return sent
+
+
+async def edit_screen(message, text, reply_markup=None, parse_mode=None):
+    """Показать экран в сообщении с кнопками
+
+    Если сообщение уже показывает то же самое, запрос не отправляется.
+    «Message is not modified» считается успехом, а новое сообщение
+    отправляется только когда старое отредактировать нельзя.
+    """
+    markup_json = reply_markup.to_json() if reply_markup else None
+    if _rendered.get(
+        (message.chat_id, message.message_id)) == (text, markup_json):
+        return message
+
+    try:
+        await message.edit_text(text,
+                                reply_markup=reply_markup,
+                                parse_mode=parse_mode)
+    except BadRequest as e:
+        error = str(e).lower()
+        if "message is not modified" in error:
+            _remember_screen(message, text, reply_markup)
+            return message
+        if not any(reason in error for reason in _EDIT_FALLBACK_ERRORS):
+            raise
+        return await reply_screen(message, text, reply_markup, parse_mode)
+
+    _remember_screen(message, text, reply_markup)
+    return message
 
 
 # ============= ГЛАВНОЕ МЕНЮ =============
@@ -36,41 +1078,34 @@ def save_data(data):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Главное меню бота"""
     context.user_data.clear()
+    # Чат снова общается с ботом — возобновляем доставку напоминаний
+    store.unpark_chat(update.effective_chat.id)
 
     keyboard = [
         [
             InlineKeyboardButton("➕ Добавить событие",
-                                 callback_data="add_event")
-        ],
-        [
-            InlineKeyboardButton("📋 Список событий",
-                                 callback_data="list_events")
+                                 callback_data=CB_ADD_EVENT)
         ],
+        [InlineKeyboardButton("📋 Список событий", callback_data=CB_LIST)],
         [
             InlineKeyboardButton("🗑️ Удалить событие",
-                                 callback_data="delete_event")
+                                 callback_data=CB_DELETE_LIST)
         ],
-        [InlineKeyboardButton("❓ Справка", callback_data="help")],
+        [InlineKeyboardButton("❓ Справка", callback_data=CB_HELP)],
     ]
 
     message_text = "🔔 *Бот напоминаний*\n\nВыберите действие:"
 
     if update.message:
-        await update.message.reply_text(
-            message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
+        await reply_screen(update.message,
+                           message_text,
+                           reply_markup=InlineKeyboardMarkup(keyboard),
+                           parse_mode="Markdown")
     elif update.callback_query:
-        try:
-            await update.callback_query.message.edit_text(
-                message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
-        except:
-            await update.callback_query.message.reply_text(
-                message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
+        await edit_screen(update.callback_query.message,
+                          message_text,
+                          reply_markup=InlineKeyboardMarkup(keyboard),
+                          parse_mode="Markdown")
 
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -78,6 +1113,19 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start(update, context)
 
 
+async def chat_migrated(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа стала супергруппой: события переезжают на её новый id"""
+    message = update.effective_message
+    if message.migrate_to_chat_id:
+        old_chat_id, new_chat_id = message.chat_id, message.migrate_to_chat_id
+    else:
+        old_chat_id, new_chat_id = message.migrate_from_chat_id, message.chat_id
+    moved = store.migrate_chat(old_chat_id, new_chat_id)
+    if moved:
+        print(f"🔀 Chat {old_chat_id} migrated to {new_chat_id}, "
+              f"moved {moved} events")
+
+
 # ============= СПРАВКА =============
 
 
@@ -117,6 +1165,7 @@ async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /menu — Главное меню бота
 /cancel — Отменить текущее действие
 /help — Показать справку
+/history — Архив прошедших событий
 /debug — Отладочная информация
 
 ⚠️ *ВАЖНО - Часовой пояс:*
@@ -139,27 +1188,21 @@ async def help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
 
     keyboard = [[
-        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+        InlineKeyboardButton("🏠 Главное меню", callback_data=CB_MAIN_MENU)
     ]]
 
     # Проверяем откуда пришёл запрос
     if update.callback_query:
         await update.callback_query.answer()
-        try:
-            await update.callback_query.message.edit_text(
-                help_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
-        except:
-            await update.callback_query.message.reply_text(
-                help_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
+        await edit_screen(update.callback_query.message,
+                          help_text,
+                          reply_markup=InlineKeyboardMarkup(keyboard),
+                          parse_mode="Markdown")
     else:
-        await update.message.reply_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
+        await reply_screen(update.message,
+                           help_text,
+                           reply_markup=InlineKeyboardMarkup(keyboard),
+                           parse_mode="Markdown")
 
 
 # ============= ОТЛАДКА =============
@@ -170,10 +1213,8 @@ async def debug_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now_utc = datetime.now(pytz.UTC)
     now_moscow = now_utc.astimezone(TIMEZONE)
 
-    data = load_data()
-    chat_events = [
-        e for e in data["events"] if e["chat_id"] == update.effective_chat.id
-    ]
+    chat_events = store.chat_events(update.effective_chat.id)
+    send_stats = rate_limiter.stats()
 
     info = f"""🔧 *Отладочная информация*
 
@@ -181,23 +1222,68 @@ async def debug_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🕐 Время UTC: `{now_utc.strftime('%Y-%m-%d %H:%M:%S')}`
 🕐 Время Москва: `{now_moscow.strftime('%Y-%m-%d %H:%M:%S')}`
 📊 События в этом чате: {len(chat_events)}
+📤 Очередь отправки: {send_stats['queued']}, ожидание ср. {send_stats['avg_wait']:.2f} с, макс. {send_stats['max_wait']:.2f} с
 
 """
 
     if chat_events:
         info += "*События:*\n"
-        for e in chat_events[:5]:  # Показать первые 5
+        for e, next_dt in chat_events[:5]:  # Показать ближайшие 5
             try:
-                event_dt = datetime.fromisoformat(e["event_time"].replace(
-                    '+00:00',
-                    '')).replace(tzinfo=pytz.UTC).astimezone(TIMEZONE)
+                event_dt = (next_dt or event_datetime(e)).astimezone(TIMEZONE)
                 info += f"• {e['title']} — {event_dt.strftime('%d.%m %H:%M')}\n"
             except:
                 info += f"• {e['title']} — ошибка парсинга даты\n"
 
+    upcoming = scheduler.upcoming(5, update.effective_chat.id)
+    if upcoming:
+        info += f"\n*Ближайшие напоминания ({REMINDER_HORIZON_HOURS} ч):*\n"
+        for fire_at, e, minutes, occurrence in upcoming:
+            fire_local = fire_at.astimezone(TIMEZONE)
+            info += f"• {fire_local.strftime('%d.%m %H:%M')} — {e['title']} (за {minutes} мин)\n"
+
+    if update.effective_user and update.effective_user.id in ADMIN_IDS:
+        info += metrics_summary()
+
     await update.message.reply_text(info, parse_mode="Markdown")
 
 
+def metrics_summary():
+    """Сводка метрик для администраторов (часть /debug)"""
+    rows = [
+        ("Тик планировщика", TICK_SECONDS),
+        ("Задержка event loop", LOOP_LAG),
+        ("Отправка", SEND_SECONDS),
+        ("Опоздание доставки", DELIVERY_LAG),
+        ("Запись хранилища", STORE_WRITE_SECONDS),
+    ]
+    status, checks = health.status()
+    problems = [
+        name for name, check in checks.items() if check["status"] != "ok"
+    ]
+    info = f"\n*Здоровье:* {status}"
+    if problems:
+        info += " (" + ", ".join(f"`{name}`" for name in problems) + ")"
+    info += "\n\n*Метрики (ср. / p95, мс):*\n"
+    for title, histogram in rows:
+        info += (f"• {title}: {histogram.mean() * 1000:.0f} / "
+                 f"{histogram.quantile(0.95) * 1000:.0f}\n")
+    info += f"• Загрузка хранилища: {STORE_LOAD_SECONDS.get() * 1000:.0f}\n"
+    info += (f"• Отправлено: {REMINDERS_SENT.total()}, "
+             f"ошибок: {SEND_FAILURES.total()}, "
+             f"в очереди повторов: {len(delivery_queue)}\n")
+
+    routes = sorted(dict(key)["route"] for key in CALLBACK_SECONDS.values)
+    if routes:
+        info += "\n*Кнопки (вызовы, ср. / p95, мс):*\n"
+        for route in routes:
+            info += (
+                f"• `{route}` — {CALLBACK_SECONDS.count(route=route)}, "
+                f"{CALLBACK_SECONDS.mean(route=route) * 1000:.0f} / "
+                f"{CALLBACK_SECONDS.quantile(0.95, route=route) * 1000:.0f}\n")
+    return info
+
+
 # ============= ОТМЕНА =============
 
 
@@ -206,27 +1292,21 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
 
     keyboard = [[
-        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+        InlineKeyboardButton("🏠 Главное меню", callback_data=CB_MAIN_MENU)
     ]]
 
     message_text = "❌ *Действие отменено*\n\nВсе несохранённые данные удалены."
 
     if update.message:
-        await update.message.reply_text(
-            message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
+        await reply_screen(update.message,
+                           message_text,
+                           reply_markup=InlineKeyboardMarkup(keyboard),
+                           parse_mode="Markdown")
     elif update.callback_query:
-        try:
-            await update.callback_query.message.edit_text(
-                message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
-        except:
-            await update.callback_query.message.reply_text(
-                message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown")
+        await edit_screen(update.callback_query.message,
+                          message_text,
+                          reply_markup=InlineKeyboardMarkup(keyboard),
+                          parse_mode="Markdown")
 
 
 # ============= ДОБАВЛЕНИЕ СОБЫТИЯ =============
@@ -240,7 +1320,7 @@ async def add_event_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["step"] = "title"
     context.user_data["chat_id"] = update.effective_chat.id
 
-    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data="cancel")]]
+    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)]]
 
     await query.message.reply_text(
         "📝 *Шаг 1/4: Название события*\n\n"
@@ -257,7 +1337,7 @@ async def add_event_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     now_local = datetime.now(TIMEZONE)
 
-    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data="cancel")]]
+    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)]]
 
     await update.message.reply_text(
         "📅 *Шаг 2/4: Дата и время*\n\n"
@@ -279,24 +1359,31 @@ async def add_event_repeat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         dt_local = TIMEZONE.localize(dt_naive)
         dt_utc = dt_local.astimezone(pytz.UTC)
 
-        context.user_data["event_time"] = dt_utc.isoformat()
+        context.user_data["event_at"] = int(dt_utc.timestamp())
         context.user_data["step"] = "repeat"
 
         keyboard = [
-            [InlineKeyboardButton("🔴 Один раз", callback_data="repeat_once")],
+            [
+                InlineKeyboardButton("🔴 Один раз",
+                                     callback_data=button_data(
+                                         CB_REPEAT, "once"))
+            ],
             [
                 InlineKeyboardButton("📆 Каждый день",
-                                     callback_data="repeat_daily")
+                                     callback_data=button_data(
+                                         CB_REPEAT, "daily"))
             ],
             [
                 InlineKeyboardButton("📅 Каждую неделю",
-                                     callback_data="repeat_weekly")
+                                     callback_data=button_data(
+                                         CB_REPEAT, "weekly"))
             ],
             [
                 InlineKeyboardButton("📊 Каждый месяц",
-                                     callback_data="repeat_monthly")
+                                     callback_data=button_data(
+                                         CB_REPEAT, "monthly"))
             ],
-            [InlineKeyboardButton("❌ Отменить", callback_data="cancel")],
+            [InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)],
         ]
 
         await update.message.reply_text(
@@ -306,7 +1393,7 @@ async def add_event_repeat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown")
     except ValueError:
         keyboard = [[
-            InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+            InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)
         ]]
         await update.message.reply_text(
             "❌ *Неверный формат даты!*\n\n"
@@ -319,32 +1406,45 @@ async def add_event_repeat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown")
 
 
-async def add_event_notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def add_event_notify(update: Update,
+                           context: ContextTypes.DEFAULT_TYPE,
+                           repeat="once"):
     """Выбор времени напоминаний"""
     query = update.callback_query
     await query.answer()
 
-    repeat_map = {
-        "repeat_once": "once",
-        "repeat_daily": "daily",
-        "repeat_weekly": "weekly",
-        "repeat_monthly": "monthly"
-    }
+    if repeat not in ("once", "daily", "weekly", "monthly"):
+        repeat = "once"
 
-    context.user_data["repeat"] = repeat_map.get(query.data, "once")
+    context.user_data["repeat"] = repeat
     context.user_data["step"] = "notify"
 
     keyboard = [
-        [InlineKeyboardButton("🔔 За 1 час", callback_data="notify_60")],
-        [InlineKeyboardButton("🔔 За 30 минут", callback_data="notify_30")],
-        [InlineKeyboardButton("🔔 За 15 минут", callback_data="notify_15")],
-        [InlineKeyboardButton("🔔 За 5 минут", callback_data="notify_5")],
-        [InlineKeyboardButton("⏰ В момент события", callback_data="notify_0")],
+        [
+            InlineKeyboardButton("🔔 За 1 час",
+                                 callback_data=button_data(CB_NOTIFY, 60))
+        ],
+        [
+            InlineKeyboardButton("🔔 За 30 минут",
+                                 callback_data=button_data(CB_NOTIFY, 30))
+        ],
+        [
+            InlineKeyboardButton("🔔 За 15 минут",
+                                 callback_data=button_data(CB_NOTIFY, 15))
+        ],
+        [
+            InlineKeyboardButton("🔔 За 5 минут",
+                                 callback_data=button_data(CB_NOTIFY, 5))
+        ],
+        [
+            InlineKeyboardButton("⏰ В момент события",
+                                 callback_data=button_data(CB_NOTIFY, 0))
+        ],
         [
             InlineKeyboardButton("✏️ Выбрать несколько",
-                                 callback_data="notify_custom")
+                                 callback_data=CB_NOTIFY_CUSTOM)
         ],
-        [InlineKeyboardButton("❌ Отменить", callback_data="cancel")],
+        [InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)],
     ]
 
     await query.message.reply_text(
@@ -363,7 +1463,7 @@ async def add_event_custom_notify(update: Update,
 
     context.user_data["step"] = "notify_custom"
 
-    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data="cancel")]]
+    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)]]
 
     await query.message.reply_text(
         "⏰ *Настройка напоминаний*\n\n"
@@ -381,22 +1481,23 @@ async def add_event_custom_notify(update: Update,
 async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE,
                      notify_minutes):
     """Сохранение события"""
-    data = load_data()
-
+    # Повторы вроде "60,60" дали бы два одинаковых напоминания
+    notify_minutes = sorted(set(notify_minutes), reverse=True)
     event = {
         "id": str(uuid.uuid4()),
         "chat_id": context.user_data["chat_id"],
         "title": context.user_data["title"],
-        "event_time": context.user_data["event_time"],
+        "event_at": context.user_data["event_at"],
         "repeat": context.user_data.get("repeat", "once"),
         "notify_minutes": notify_minutes,
         "created_by": update.effective_user.id,
         "created_at": datetime.utcnow().isoformat(),
-        "sent_notifications": []
+        "delivered": {}
     }
 
-    data["events"].append(event)
-    save_data(data)
+    store.add(event)
+    store.unpark_chat(event["chat_id"])
+    scheduler.schedule_event(event)
 
     repeat_text = {
         "once": "Один раз",
@@ -418,7 +1519,7 @@ async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE,
             days = m // 1440
             notify_text.append(f"за {days} д")
 
-    event_dt_utc = datetime.fromisoformat(event["event_time"])
+    event_dt_utc = event_datetime(event)
     event_dt_local = event_dt_utc.astimezone(TIMEZONE)
 
     success_message = (
@@ -431,7 +1532,7 @@ async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE,
     context.user_data.clear()
 
     keyboard = [[
-        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+        InlineKeyboardButton("🏠 Главное меню", callback_data=CB_MAIN_MENU)
     ]]
 
     if update.message:
@@ -448,51 +1549,60 @@ async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 # ============= СПИСОК СОБЫТИЙ =============
 
-
-async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать список событий"""
-    query = update.callback_query
-    await query.answer()
-
-    data = load_data()
-    chat_events = [
-        e for e in data["events"] if e["chat_id"] == update.effective_chat.id
-    ]
-
-    if not chat_events:
-        try:
-            await query.message.edit_text(
-                "📋 *Список событий*\n\n"
-                "Событий пока нет.\n"
-                "Создайте первое событие!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
-        except:
-            await query.message.reply_text(
-                "📋 *Список событий*\n\n"
-                "Событий пока нет.\n"
-                "Создайте первое событие!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
-        return
-
-    chat_events.sort(key=lambda e: datetime.fromisoformat(e[
-        "event_time"].replace('+00:00', '')))
-
+# Событий на одной странице списка
+PAGE_SIZE = 10
+
+# Отрисованные страницы: chat_id -> (ревизия, {(вид, страница): (текст, кнопки)})
+_page_cache = {}
+
+
+def cached_page(chat_id, kind, page, render):
+    """Страница из кэша чата; кэш сбрасывается при изменении событий чата"""
+    chat_events = store.chat_events(chat_id)
+    revision = store.chat_revision(chat_id)
+    cached = _page_cache.get(chat_id)
+    if not cached or cached[0] != revision:
+        cached = _page_cache[chat_id] = (revision, {})
+    key = (kind, page)
+    if key not in cached[1]:
+        cached[1][key] = render(chat_events, page)
+    return cached[1][key]
+
+
+def page_bounds(chat_events, page):
+    """Номер страницы в допустимых пределах, число страниц и срез"""
+    pages = max(1, -(-len(chat_events) // PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * PAGE_SIZE
+    return page, pages, start, chat_events[start:start + PAGE_SIZE]
+
+
+def page_navigation(page, pages, code):
+    """Ряд кнопок «назад/вперёд» или пустой список"""
+    row = []
+    if page > 0:
+        row.append(
+            InlineKeyboardButton("◀️ Назад",
+                                 callback_data=button_data(code, page - 1)))
+    if page < pages - 1:
+        row.append(
+            InlineKeyboardButton("Вперёд ▶️",
+                                 callback_data=button_data(code, page + 1)))
+    return [row] if row else []
+
+
+def render_list_page(chat_events, page):
+    page, pages, start, visible = page_bounds(chat_events, page)
     repeat_emoji = {"once": "🔴", "daily": "📆", "weekly": "📅", "monthly": "📊"}
 
-    message = "📋 *Список событий*\n\n"
+    message = "📋 *Список событий*"
+    if pages > 1:
+        message += f" (стр. {page + 1}/{pages})"
+    message += "\n\n"
 
-    for i, event in enumerate(chat_events, 1):
+    for i, (event, next_dt) in enumerate(visible, start + 1):
         try:
-            event_dt_utc = datetime.fromisoformat(event["event_time"].replace(
-                '+00:00', '')).replace(tzinfo=pytz.UTC)
+            event_dt_utc = next_dt or event_datetime(event)
             event_dt_local = event_dt_utc.astimezone(TIMEZONE)
             emoji = repeat_emoji.get(event.get("repeat", "once"), "🔴")
             message += f"{i}. {emoji} *{event['title']}*\n"
@@ -500,170 +1610,194 @@ async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             message += f"{i}. ❓ *{event['title']}* (ошибка даты)\n\n"
 
-    keyboard = [[
-        InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+    keyboard = page_navigation(page, pages, CB_LIST) + [[
+        InlineKeyboardButton("🏠 Главное меню", callback_data=CB_MAIN_MENU)
     ]]
-
-    try:
-        await query.message.edit_text(
-            message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
-    except:
-        await query.message.reply_text(
-            message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
+    return message, keyboard
 
 
-# ============= УДАЛЕНИЕ СОБЫТИЯ =============
-
-
-async def delete_event_list(update: Update,
-                            context: ContextTypes.DEFAULT_TYPE):
-    """Показать список для удаления"""
+async def list_events(update: Update,
+                      context: ContextTypes.DEFAULT_TYPE,
+                      page=0):
+    """Показать список событий (по страницам)"""
     query = update.callback_query
     await query.answer()
 
-    data = load_data()
-    chat_events = [
-        e for e in data["events"] if e["chat_id"] == update.effective_chat.id
-    ]
+    chat_events = store.chat_events(update.effective_chat.id)
 
     if not chat_events:
-        try:
-            await query.message.edit_text(
-                "🗑️ *Удаление событий*\n\n"
-                "Нет событий для удаления.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
-        except:
-            await query.message.reply_text(
-                "🗑️ *Удаление событий*\n\n"
-                "Нет событий для удаления.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
+        await edit_screen(query.message, "📋 *Список событий*\n\n"
+                          "Событий пока нет.\n"
+                          "Создайте первое событие!",
+                          reply_markup=InlineKeyboardMarkup([[
+                              InlineKeyboardButton("🏠 Главное меню",
+                                                   callback_data=CB_MAIN_MENU)
+                          ]]),
+                          parse_mode="Markdown")
         return
 
+    message, keyboard = cached_page(update.effective_chat.id, "list", page,
+                                    render_list_page)
+
+    await edit_screen(query.message,
+                      message,
+                      reply_markup=InlineKeyboardMarkup(keyboard),
+                      parse_mode="Markdown")
+
+
+# ============= УДАЛЕНИЕ СОБЫТИЯ =============
+
+
+def render_delete_page(chat_events, page):
+    page, pages, start, visible = page_bounds(chat_events, page)
+
+    message = "🗑️ *Удаление событий*"
+    if pages > 1:
+        message += f" (стр. {page + 1}/{pages})"
+    message += "\n\nВыберите событие для удаления:"
+
     keyboard = []
-    for event in chat_events:
+    for event, next_dt in visible:
         try:
-            event_dt_utc = datetime.fromisoformat(event["event_time"].replace(
-                '+00:00', '')).replace(tzinfo=pytz.UTC)
+            event_dt_utc = next_dt or event_datetime(event)
             event_dt_local = event_dt_utc.astimezone(TIMEZONE)
             button_text = f"🗑️ {event['title']} ({event_dt_local.strftime('%d.%m')})"
         except:
             button_text = f"🗑️ {event['title']}"
         keyboard.append([
             InlineKeyboardButton(button_text,
-                                 callback_data=f"del_{event['id']}")
+                                 callback_data=button_data(
+                                     CB_DELETE, short_id(event["id"])))
         ])
 
+    keyboard += page_navigation(page, pages, CB_DELETE_LIST)
     keyboard.append(
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+        [InlineKeyboardButton("🏠 Главное меню", callback_data=CB_MAIN_MENU)])
+    return message, keyboard
 
-    try:
-        await query.message.edit_text(
-            "🗑️ *Удаление событий*\n\n"
-            "Выберите событие для удаления:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
-    except:
-        await query.message.reply_text(
-            "🗑️ *Удаление событий*\n\n"
-            "Выберите событие для удаления:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown")
+
+async def delete_event_list(update: Update,
+                            context: ContextTypes.DEFAULT_TYPE,
+                            page=0):
+    """Показать список для удаления (по страницам)"""
+    query = update.callback_query
+    await query.answer()
+
+    chat_events = store.chat_events(update.effective_chat.id)
+
+    if not chat_events:
+        await edit_screen(query.message, "🗑️ *Удаление событий*\n\n"
+                          "Нет событий для удаления.",
+                          reply_markup=InlineKeyboardMarkup([[
+                              InlineKeyboardButton("🏠 Главное меню",
+                                                   callback_data=CB_MAIN_MENU)
+                          ]]),
+                          parse_mode="Markdown")
+        return
+
+    message, keyboard = cached_page(update.effective_chat.id, "delete", page,
+                                    render_delete_page)
+
+    await edit_screen(query.message,
+                      message,
+                      reply_markup=InlineKeyboardMarkup(keyboard),
+                      parse_mode="Markdown")
 
 
 async def delete_event_confirm(update: Update,
-                               context: ContextTypes.DEFAULT_TYPE):
+                               context: ContextTypes.DEFAULT_TYPE, event_id):
     """Удалить событие"""
     query = update.callback_query
     await query.answer()
 
-    event_id = query.data.replace("del_", "")
-
-    data = load_data()
-    event = next((e for e in data["events"] if e["id"] == event_id), None)
+    event = store.delete(event_id)
+    scheduler.remove_event(event_id)
 
     if event:
-        data["events"] = [e for e in data["events"] if e["id"] != event_id]
-        save_data(data)
-
-        try:
-            await query.message.edit_text(
-                f"✅ Событие *{event['title']}* удалено!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
-        except:
-            await query.message.reply_text(
-                f"✅ Событие *{event['title']}* удалено!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главное меню",
-                                         callback_data="main_menu")
-                ]]),
-                parse_mode="Markdown")
+        await edit_screen(query.message,
+                          f"✅ Событие *{event['title']}* удалено!",
+                          reply_markup=InlineKeyboardMarkup([[
+                              InlineKeyboardButton("🏠 Главное меню",
+                                                   callback_data=CB_MAIN_MENU)
+                          ]]),
+                          parse_mode="Markdown")
     else:
-        try:
-            await query.message.edit_text("❌ Событие не найдено.",
-                                          reply_markup=InlineKeyboardMarkup([[
-                                              InlineKeyboardButton(
-                                                  "🏠 Главное меню",
-                                                  callback_data="main_menu")
-                                          ]]),
-                                          parse_mode="Markdown")
-        except:
-            await query.message.reply_text("❌ Событие не найдено.",
-                                           reply_markup=InlineKeyboardMarkup([[
-                                               InlineKeyboardButton(
-                                                   "🏠 Главное меню",
-                                                   callback_data="main_menu")
-                                           ]]),
-                                           parse_mode="Markdown")
+        await edit_screen(query.message,
+                          "❌ Событие не найдено.",
+                          reply_markup=InlineKeyboardMarkup([[
+                              InlineKeyboardButton("🏠 Главное меню",
+                                                   callback_data=CB_MAIN_MENU)
+                          ]]),
+                          parse_mode="Markdown")
+
+
+# ============= ИСТОРИЯ =============
+
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать архив прошедших разовых событий"""
+    events = await store.run_io(archive.query, update.effective_chat.id,
+                                HISTORY_LIMIT)
+
+    if not events:
+        await update.message.reply_text(
+            "🗄️ *История событий*\n\n"
+            "Архив пуст.", parse_mode="Markdown")
+        return
+
+    message = "🗄️ *История событий*\n\n"
+    for event in events:
+        event_local = event_datetime(event).astimezone(TIMEZONE)
+        message += f"• *{event['title']}* — {event_local.strftime('%d.%m.%Y в %H:%M')}\n"
+
+    await update.message.reply_text(message, parse_mode="Markdown")
 
 
 # ============= ОБРАБОТЧИКИ =============
 
 
+async def save_event_notify(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            minutes):
+    """Сохранение события с одним напоминанием"""
+    await save_event(update, context, [minutes])
+
+
+# Маршруты кнопок: код -> (обработчик, типы аргументов)
+CALLBACK_ROUTES = {
+    CB_MAIN_MENU: (start, ()),
+    CB_HELP: (help_menu, ()),
+    CB_CANCEL: (cancel, ()),
+    CB_ADD_EVENT: (add_event_start, ()),
+    CB_LIST: (list_events, (int, )),
+    CB_DELETE_LIST: (delete_event_list, (int, )),
+    CB_DELETE: (delete_event_confirm, (full_id, )),
+    CB_REPEAT: (add_event_notify, (str, )),
+    CB_NOTIFY: (save_event_notify, (int, )),
+    CB_NOTIFY_CUSTOM: (add_event_custom_notify, ()),
+}
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий кнопок"""
     query = update.callback_query
+    code, raw_args = parse_callback(query.data or "")
+    route = CALLBACK_ROUTES.get(code)
+
+    if not route or len(raw_args) > len(route[1]):
+        print(f"⚠️ Unknown callback: {query.data}")
+        await query.answer()
+        return
 
+    started = time.monotonic()
     try:
-        if query.data == "main_menu":
-            await start(update, context)
-        elif query.data == "help":
-            await help_menu(update, context)
-        elif query.data == "cancel":
-            await cancel(update, context)
-        elif query.data == "add_event":
-            await add_event_start(update, context)
-        elif query.data == "list_events":
-            await list_events(update, context)
-        elif query.data == "delete_event":
-            await delete_event_list(update, context)
-        elif query.data.startswith("repeat_"):
-            await add_event_notify(update, context)
-        elif query.data == "notify_custom":
-            await add_event_custom_notify(update, context)
-        elif query.data.startswith("notify_"):
-            minutes = int(query.data.replace("notify_", ""))
-            await save_event(update, context, [minutes])
-        elif query.data.startswith("del_"):
-            await delete_event_confirm(update, context)
+        handler, arg_types = route
+        args = [convert(raw) for convert, raw in zip(arg_types, raw_args)]
+        await handler(update, context, *args)
     except Exception as e:
         print(f"❌ Error in button_handler: {e}")
         await query.answer("Произошла ошибка. Попробуйте ещё раз.")
+    finally:
+        CALLBACK_SECONDS.observe(time.monotonic() - started, route=code)
 
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -683,7 +1817,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await save_event(update, context, notify_minutes)
             except ValueError:
                 keyboard = [[
-                    InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+                    InlineKeyboardButton("❌ Отменить", callback_data=CB_CANCEL)
                 ]]
                 await update.message.reply_text(
                     "❌ *Неверный формат!*\n\n"
@@ -703,11 +1837,47 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============= НАПОМИНАНИЯ =============
 
-
-def get_next_occurrence(event_time, repeat_type):
-    """Получить следующее время события с учётом повторения"""
-    now = datetime.now(pytz.UTC)
-
+# Допустимое опоздание напоминания (секунды)
+REMINDER_GRACE = 45
+# Максимальный сон планировщика (защита от перевода системных часов)
+MAX_SCHEDULER_SLEEP = 3600
+# Горизонт таблицы ближайших напоминаний и период его продления
+REMINDER_HORIZON_HOURS = int(os.environ.get("REMINDER_HORIZON_HOURS", "48"))
+REMINDER_HORIZON = timedelta(hours=REMINDER_HORIZON_HOURS)
+HORIZON_REFRESH = 3600
+
+# Лимиты Telegram: всего сообщений в секунду, в один чат в секунду,
+# в одну группу в минуту
+GLOBAL_SEND_RATE = float(os.environ.get("GLOBAL_SEND_RATE", "30"))
+CHAT_SEND_RATE = float(os.environ.get("CHAT_SEND_RATE", "1"))
+GROUP_SENDS_PER_MINUTE = float(os.environ.get("GROUP_SENDS_PER_MINUTE", "20"))
+
+# Окно объединения одновременных напоминаний одного чата
+COALESCE_WINDOW = timedelta(
+    seconds=float(os.environ.get("COALESCE_WINDOW", "2")))
+# Лимит длины сообщения Telegram и разделитель объединённых напоминаний
+MESSAGE_LIMIT = 4096
+REMINDER_SEPARATOR = "\n\n➖➖➖\n\n"
+
+# Повторные попытки отправки: базовая и максимальная пауза, число попыток
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "5"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "900"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "10"))
+
+# Напоминания, опоздавшие сильнее (минуты), приходят одной сводкой
+CATCHUP_STALE_MINUTES = int(os.environ.get("CATCHUP_STALE_MINUTES", "60"))
+CATCHUP_STALE_AFTER = timedelta(minutes=CATCHUP_STALE_MINUTES)
+# Сколько пропущенных напоминаний досылать за один заход
+CATCHUP_BATCH = int(os.environ.get("CATCHUP_BATCH", "200"))
+# Сколько строк показывать в сводке пропущенных напоминаний
+CATCHUP_SUMMARY_LINES = 20
+
+# Шаг повторения для событий с фиксированным периодом
+REPEAT_STEPS = {"daily": timedelta(days=1), "weekly": timedelta(weeks=1)}
+
+
+def parse_event_time(event_time):
+    """Привести event_time (строка ISO или datetime) к datetime в UTC"""
     try:
         if isinstance(event_time, str):
             event_time_clean = event_time.replace('+00:00', '')
@@ -717,30 +1887,787 @@ def get_next_occurrence(event_time, repeat_type):
 
         if event_dt.tzinfo is None:
             event_dt = pytz.UTC.localize(event_dt)
+        return event_dt
     except Exception as e:
         print(f"❌ Error parsing event_time: {event_time}, error: {e}")
         return None
 
+
+def add_months(dt, months):
+    """Сдвинуть дату на месяцы, прижимая день к концу короткого месяца"""
+    month_index = dt.month - 1 + months
+    year = dt.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+
+def _occurrence_after(event_dt, repeat_type, now):
+    """Первое повторение события строго после now (за O(1))"""
+    if event_dt > now:
+        return event_dt
+
+    if repeat_type in REPEAT_STEPS:
+        step = REPEAT_STEPS[repeat_type]
+        steps = (now - event_dt) // step + 1
+        return event_dt + steps * step
+
+    if repeat_type == "monthly":
+        # Месяцы считаем по местному календарю, всегда от исходной даты,
+        # чтобы 31-е число не «съезжало» после февраля
+        base_local = event_dt.astimezone(TIMEZONE).replace(tzinfo=None)
+        now_local = now.astimezone(TIMEZONE)
+        months = ((now_local.year - base_local.year) * 12 + now_local.month -
+                  base_local.month)
+        for offset in (months, months + 1):
+            candidate = TIMEZONE.localize(add_months(
+                base_local, offset)).astimezone(pytz.UTC)
+            if candidate > now:
+                return candidate
+
+    return None
+
+
+def get_next_occurrence(event_time, repeat_type, now=None):
+    """Получить следующее время события с учётом повторения"""
+    if now is None:
+        now = datetime.now(pytz.UTC)
+
+    event_dt = parse_event_time(event_time)
+    if event_dt is None:
+        return None
+
     if not repeat_type or repeat_type == "once":
         return event_dt if event_dt > now else None
 
-    next_dt = event_dt
+    return _occurrence_after(event_dt, repeat_type, now)
+
+
+def get_next_occurrences(items):
+    """Пакетный расчёт повторений: [(event_dt, repeat_type, now)] -> [datetime|None]
 
-    max_iterations = 365  # Защита от бесконечного цикла
-    iterations = 0
+    Строки ISO (старый формат) разбираются один раз на всю пачку.
+    """
+    parsed = {}
+    result = []
+    for event_dt, repeat_type, now in items:
+        if isinstance(event_dt, str):
+            if event_dt not in parsed:
+                parsed[event_dt] = parse_event_time(event_dt)
+            event_dt = parsed[event_dt]
 
-    while next_dt <= now and iterations < max_iterations:
-        if repeat_type == "daily":
-            next_dt += timedelta(days=1)
-        elif repeat_type == "weekly":
-            next_dt += timedelta(weeks=1)
-        elif repeat_type == "monthly":
-            next_dt += timedelta(days=30)
+        if event_dt is None:
+            result.append(None)
+        elif not repeat_type or repeat_type == "once":
+            result.append(event_dt if event_dt > now else None)
         else:
-            break
-        iterations += 1
+            result.append(_occurrence_after(event_dt, repeat_type, now))
+    return result
+
+
+def format_reminder(event, occurrence, minutes):
+    """Текст напоминания о событии"""
+    event_local = occurrence.astimezone(TIMEZONE)
+    # Название пользовательское: без экранирования `_` или `*` в нём
+    # ломают разметку всего объединённого сообщения
+    title = escape_markdown(event['title'])
+
+    if minutes == 0:
+        return f"⏰ *Событие началось!*\n\n📝 {title}\n🕐 {event_local.strftime('%H:%M')}"
+    elif minutes < 60:
+        return f"⏰ *Напоминание*\n\n📝 {title}\n⏱ Через {minutes} мин\n🕐 Событие в {event_local.strftime('%H:%M')}"
+    elif minutes < 1440:
+        hours = minutes // 60
+        return f"⏰ *Напоминание*\n\n📝 {title}\n⏱ Через {hours} ч\n🕐 Событие в {event_local.strftime('%H:%M')}"
+    else:
+        days = minutes // 1440
+        return f"⏰ *Напоминание*\n\n📝 {title}\n⏱ Через {days} д\n📅 Событие {event_local.strftime('%d.%m в %H:%M')}"
+
+
+def format_missed_summary(items):
+    """Одно сообщение о напоминаниях, опоздавших дальше порога"""
+    lines = []
+    for event, minutes, occurrence, attempt in items[:CATCHUP_SUMMARY_LINES]:
+        event_local = occurrence.astimezone(TIMEZONE)
+        line = (f"• {escape_markdown(event['title'])} — "
+                f"{event_local.strftime('%d.%m в %H:%M')}")
+        if minutes:
+            line += f" (напоминание за {minutes} мин)"
+        lines.append(line)
+    if len(items) > CATCHUP_SUMMARY_LINES:
+        lines.append(f"…и ещё {len(items) - CATCHUP_SUMMARY_LINES}")
+    return ("⏰ *Пропущенные напоминания*\n\n"
+            "Бот не смог напомнить вовремя о событиях:\n" +
+            "\n".join(lines))[:MESSAGE_LIMIT]
+
+
+def missed_reminders(events, since, until):
+    """Напоминания со временем срабатывания в (since, until], не отправленные
+
+    Для каждой пары (событие, напоминание) берётся только последнее
+    пропущенное повторение: о более ранних напоминать уже поздно.
+    Результат — [(event, minutes, occurrence, 0)] по времени срабатывания.
+    """
+    missed = []
+    for event in events:
+        if "event_at" not in event or "notify_minutes" not in event:
+            continue
+        start = since
+        if event.get("created_at"):
+            start = max(since, parse_event_time(event["created_at"]) or since)
+        for minutes in event["notify_minutes"]:
+            offset = timedelta(minutes=minutes)
+            last = None
+            occurrence = get_next_occurrence(event_datetime(event),
+                                             event.get("repeat", "once"),
+                                             start + offset)
+            while occurrence and occurrence - offset <= until:
+                last = occurrence
+                occurrence = get_next_occurrence(event_datetime(event),
+                                                 event.get("repeat", "once"),
+                                                 occurrence)
+            if last and not is_delivered(event, minutes, last):
+                missed.append((last - offset, event, minutes, last))
+    missed.sort(key=lambda row: row[0])
+    return [(event, minutes, occurrence, 0)
+            for fire_at, event, minutes, occurrence in missed]
+
+
+class ReminderScheduler:
+    """Материализованная таблица ближайших напоминаний
+
+    Строки (fire_at, event_id, minutes, occurrence) всех повторений,
+    срабатывающих в пределах горизонта (по умолчанию 48 часов), лежат
+    в min-heap. Для каждой пары (событие, напоминание) первая строка
+    за горизонтом ждёт в отдельной куче и переносится в таблицу, когда
+    горизонт до неё дотягивается.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._future = []
+        self.horizon_end = None
+        # Поколение записей события: устаревшие записи в куче пропускаются
+        self._generation = {}
+        # Сигнал досрочного пробуждения цикла напоминаний
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def rebuild(self, events, now=None):
+        """Построить очередь заново по всем событиям"""
+        if now is None:
+            now = datetime.now(pytz.UTC)
+        self._heap = []
+        self._future = []
+        self._generation = {}
+        self.horizon_end = now + REMINDER_HORIZON
+
+        pending = []
+        for event in events:
+            if "event_at" not in event or "notify_minutes" not in event:
+                continue
+            self._generation[event["id"]] = 1
+            for minutes in event["notify_minutes"]:
+                pending.append((event, minutes))
+
+        occurrences = get_next_occurrences(
+            (event_datetime(event), event.get("repeat", "once"),
+             now + timedelta(minutes=minutes, seconds=-REMINDER_GRACE))
+            for event, minutes in pending)
+        for (event, minutes), occurrence in zip(pending, occurrences):
+            self._place(event, minutes, occurrence, 1)
+        self._wakeup.set()
+        print(f"📬 Scheduler rebuilt: {len(self._heap)} reminders within "
+              f"{REMINDER_HORIZON_HOURS} h")
+
+    def schedule_event(self, event, now=None):
+        """Поставить в очередь ближайшие напоминания события"""
+        if "event_at" not in event or "notify_minutes" not in event:
+            return
+        if now is None:
+            now = datetime.now(pytz.UTC)
+        if self.horizon_end is None:
+            self.horizon_end = now + REMINDER_HORIZON
+
+        generation = self._generation.get(event["id"], 0) + 1
+        self._generation[event["id"]] = generation
+
+        for minutes in event["notify_minutes"]:
+            # Ищем первое повторение, напоминание о котором ещё не прошло
+            after = now + timedelta(minutes=minutes, seconds=-REMINDER_GRACE)
+            occurrence = get_next_occurrence(event_datetime(event),
+                                             event.get("repeat", "once"),
+                                             after)
+            self._place(event, minutes, occurrence, generation)
+
+    def remove_event(self, event_id):
+        """Снять все напоминания события"""
+        self._generation.pop(event_id, None)
+
+    def _place(self, event, minutes, occurrence, generation):
+        """Добавить строки повторений до горизонта, следующую — в запас"""
+        while occurrence:
+            fire_at = occurrence - timedelta(minutes=minutes)
+            row = (fire_at, event["id"], minutes, occurrence, generation)
+            if fire_at > self.horizon_end:
+                heapq.heappush(self._future, row)
+                return
+            if not self._heap or fire_at < self._heap[0][0]:
+                self._wakeup.set()
+            heapq.heappush(self._heap, row)
+            occurrence = get_next_occurrence(event_datetime(event),
+                                             event.get("repeat", "once"),
+                                             occurrence)
+
+    def _is_live(self, row):
+        return self._generation.get(row[1]) == row[4]
+
+    def extend(self, now):
+        """Сдвинуть горизонт: перенести в таблицу строки, попавшие в него"""
+        self.horizon_end = max(self.horizon_end, now + REMINDER_HORIZON)
+        while self._future and self._future[0][0] <= self.horizon_end:
+            row = heapq.heappop(self._future)
+            event = store.get(row[1])
+            if self._is_live(row) and event:
+                self._place(event, row[2], row[3], row[4])
+
+    def upcoming(self, limit=5, chat_id=None):
+        """Ближайшие строки таблицы: [(fire_at, event, minutes, occurrence)]"""
+
+        def rows():
+            for row in self._heap:
+                if not self._is_live(row):
+                    continue
+                # Событие могли удалить, а его строки ещё лежат в куче
+                event = store.get(row[1])
+                if event is None or (chat_id is not None
+                                     and event["chat_id"] != chat_id):
+                    continue
+                yield row[0], event, row[2], row[3]
 
-    return next_dt if next_dt > now else None
+        return heapq.nsmallest(limit, rows(), key=lambda row: row[0])
+
+    def next_fire_at(self):
+        """Время ближайшего актуального напоминания или None"""
+        while self._heap:
+            if self._is_live(self._heap[0]):
+                return self._heap[0][0]
+            heapq.heappop(self._heap)
+        return None
+
+    async def wait_next(self, max_sleep=MAX_SCHEDULER_SLEEP):
+        """Спать до ближайшего напоминания или до досрочного пробуждения"""
+        self._wakeup.clear()
+        fire_at = self.next_fire_at()
+        timeout = max_sleep
+        if fire_at is not None:
+            delay = (fire_at - datetime.now(pytz.UTC)).total_seconds()
+            timeout = min(max(delay, 0), max_sleep)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def pop_due(self, now):
+        """Извлечь наступившие напоминания: [(event, minutes, occurrence)]"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            row = heapq.heappop(self._heap)
+            fire_at, event_id, minutes, occurrence, generation = row
+            if not self._is_live(row):
+                continue
+            event = store.get(event_id)
+            if not event:
+                continue
+            # Опоздавшие строки (долгий тик, пауза) не теряются:
+            # send_reminders сам решит, слать их или собрать в сводку
+            due.append((event, minutes, occurrence))
+        # Следующие повторения сработавших событий подтягиваются в таблицу
+        self.extend(now)
+        return due
+
+
+scheduler = ReminderScheduler()
+
+
+async def extend_horizon():
+    """Фоновое продление горизонта таблицы напоминаний"""
+    while True:
+        await asyncio.sleep(HORIZON_REFRESH)
+        try:
+            scheduler.extend(datetime.now(pytz.UTC))
+        except Exception as e:
+            print(f"❌ Error extending reminder horizon: {e}")
+
+
+class TokenBucket:
+    """Маркерная корзина с резервированием: очередь без блокировок"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Занять маркер, вернуть сколько секунд ждать своей очереди"""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def wait_time(self):
+        """Сколько ждать до появления маркера (без его захвата)"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def idle(self):
+        """Корзина полна, её можно забыть без потери состояния"""
+        refill = (time.monotonic() - self.updated) * self.rate
+        return self.tokens + refill >= self.capacity
+
+
+class SendRateLimiter:
+    """Ограничитель отправки с учётом глобального лимита и лимитов чатов"""
+
+    def __init__(self,
+                 global_rate=GLOBAL_SEND_RATE,
+                 chat_rate=CHAT_SEND_RATE,
+                 group_per_minute=GROUP_SENDS_PER_MINUTE):
+        # Без запаса: иначе в первую секунду уйдёт вдвое больше лимита
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_rate = chat_rate
+        self.group_per_minute = group_per_minute
+        # chat_id -> (очередь чата, [корзины чата])
+        self._chats = {}
+        # Паузы по RetryAfter: chat_id -> monotonic, None -> весь бот
+        self._paused_until = {}
+        self._recent_flood = []
+        self.queued = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _chat_limits(self, chat_id):
+        limits = self._chats.get(chat_id)
+        if limits is None:
+            if len(self._chats) > 10000:
+                self._chats = {
+                    key: value
+                    for key, value in self._chats.items()
+                    if value[0].locked() or not all(b.idle() for b in value[1])
+                }
+            buckets = [TokenBucket(self.chat_rate, 1)]
+            if chat_id < 0:  # группы и каналы
+                buckets.append(
+                    TokenBucket(self.group_per_minute / 60,
+                                self.group_per_minute))
+            limits = (asyncio.Lock(), buckets)
+            self._chats[chat_id] = limits
+        return limits
+
+    async def acquire(self, chat_id):
+        """Дождаться разрешения на отправку в чат"""
+        self.queued += 1
+        started = time.monotonic()
+        lock, buckets = self._chat_limits(chat_id)
+        try:
+            # Сообщения одного чата идут по очереди; глобальный маркер
+            # берём, когда чат уже готов, чтобы не занимать общую полосу
+            async with lock:
+                while True:
+                    delay = max([b.wait_time() for b in buckets] +
+                                [self._pause_left(chat_id)])
+                    if not delay:
+                        break
+                    await asyncio.sleep(delay)
+                while self._pause_left(None):
+                    await asyncio.sleep(self._pause_left(None))
+                delay = self.global_bucket.reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+                # Маркер чата списываем в момент фактической отправки
+                for bucket in buckets:
+                    bucket.consume()
+        finally:
+            self.queued -= 1
+        waited = time.monotonic() - started
+        self.sent += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def _pause_left(self, key):
+        until = self._paused_until.get(key)
+        if until is None:
+            return 0.0
+        left = until - time.monotonic()
+        if left <= 0:
+            del self._paused_until[key]
+            return 0.0
+        return left
+
+    def pause(self, chat_id, seconds):
+        """Учесть RetryAfter: притормозить чат, а при массовом флуде — всех"""
+        now = time.monotonic()
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0),
+                                          now + seconds)
+        self._recent_flood = [
+            (t, c) for t, c in self._recent_flood if now - t < 1
+        ] + [(now, chat_id)]
+        # Несколько разных чатов подряд — значит, сработал общий лимит бота
+        if len({c for _, c in self._recent_flood}) >= 3:
+            self._paused_until[None] = max(self._paused_until.get(None, 0),
+                                           now + seconds)
+            print(f"⏸️ Flood control: pausing all sends for {seconds} s")
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "avg_wait": self.total_wait / self.sent if self.sent else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+rate_limiter = SendRateLimiter()
+# Отправки в полёте: ссылки держим, чтобы задачи не собрал GC
+_delivery_tasks = set()
+
+
+def is_delivered(event, minutes, occurrence):
+    """Напоминание об этом повторении уже отправлялось (O(1))"""
+    delivered = event.get("delivered", {}).get(str(minutes), 0)
+    return delivered >= int(occurrence.timestamp())
+
+
+def retry_delay(attempt):
+    """Экспоненциальная пауза перед повтором, со случайным разбросом"""
+    delay = min(RETRY_BASE_DELAY * 2**attempt, RETRY_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class DeliveryQueue:
+    """Повторная доставка напоминаний, которые не удалось отправить
+
+    Записи хранятся в store (переживают перезапуск), паузы растут
+    экспоненциально, а RetryAfter задаёт паузу явно.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def load(self):
+        """Поднять очередь повторов из хранилища"""
+        self._heap = [(entry["next_try"], entry["key"])
+                      for entry in store.retries()]
+        heapq.heapify(self._heap)
+        if self._heap:
+            print(f"🔁 Restored {len(self._heap)} pending retries")
+
+    def retry(self, event, minutes, occurrence, attempt, delay=None):
+        """Запланировать повтор; вернуть False, если попытки исчерпаны"""
+        if attempt >= RETRY_MAX_ATTEMPTS:
+            return False
+        if delay is None:
+            delay = retry_delay(attempt)
+        entry = {
+            "key": retry_key(event, minutes, occurrence),
+            "event_id": event["id"],
+            "minutes": minutes,
+            "occurrence": int(occurrence.timestamp()),
+            "attempt": attempt + 1,
+            "next_try": time.time() + delay,
+        }
+        store.put_retry(entry)
+        if not self._heap or entry["next_try"] < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (entry["next_try"], entry["key"]))
+        return True
+
+    async def run(self, bot):
+        """Фоновая отправка повторов по наступлении их времени"""
+        print("🔁 Retry queue started!")
+        while True:
+            health.beat("dispatcher")
+            try:
+                now = time.time()
+                outbox = store.data.get("outbox", {})
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, key = heapq.heappop(self._heap)
+                    entry = outbox.get(key)
+                    if not entry:
+                        continue
+                    event = store.get(entry["event_id"])
+                    if not event:
+                        store.drop_retry(key)
+                        continue
+                    due.append(
+                        (event, entry["minutes"],
+                         datetime.fromtimestamp(entry["occurrence"],
+                                                pytz.UTC), entry["attempt"]))
+                dispatch_reminders(bot, due)
+
+                self._wakeup.clear()
+                # Просыпаемся не реже отметок живости
+                timeout = HEARTBEAT_INTERVAL
+                if self._heap:
+                    timeout = min(max(self._heap[0][0] - time.time(), 0),
+                                  HEARTBEAT_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                print(f"❌ Error in retry queue: {e}")
+                await asyncio.sleep(30)
+
+
+delivery_queue = DeliveryQueue()
+
+
+def retry_key(event, minutes, occurrence):
+    return f"{event['id']}_{int(occurrence.timestamp())}_{minutes}"
+
+
+def pack_reminders(items):
+    """Разложить напоминания чата по сообщениям не длиннее лимита Telegram"""
+    chunks = []
+    text = ""
+    chunk = []
+    for item in items:
+        event, minutes, occurrence, attempt = item
+        block = format_reminder(event, occurrence, minutes)[:MESSAGE_LIMIT]
+        if chunk and len(text) + len(REMINDER_SEPARATOR) + len(
+                block) > MESSAGE_LIMIT:
+            chunks.append((text, chunk))
+            text, chunk = "", []
+        text = f"{text}{REMINDER_SEPARATOR}{block}" if chunk else block
+        chunk.append(item)
+    if chunk:
+        chunks.append((text, chunk))
+    return chunks
+
+
+def render_chunk(items, missed=False):
+    """Заново собрать текст сообщения для оставшихся напоминаний
+
+    Часть напоминаний может отпасть, пока сообщение ждёт очереди;
+    текст короче исходного, поэтому в лимит длины он укладывается.
+    """
+    if missed:
+        return format_missed_summary(items)
+    return REMINDER_SEPARATOR.join(
+        format_reminder(event, occurrence, minutes)[:MESSAGE_LIMIT]
+        for event, minutes, occurrence, attempt in items)
+
+
+def dispatch_reminders(bot, items):
+    """Сгруппировать напоминания по чатам и отправить параллельно"""
+    by_chat = {}
+    for item in items:
+        by_chat.setdefault(item[0]["chat_id"], []).append(item)
+    # Чаты обслуживаются параллельно, темп задаёт rate_limiter
+    tasks = []
+    for chat_id, chat_items in by_chat.items():
+        task = asyncio.create_task(send_reminders(bot, chat_id, chat_items))
+        _delivery_tasks.add(task)
+        task.add_done_callback(_delivery_tasks.discard)
+        tasks.append(task)
+    return tasks
+
+
+async def send_reminders(bot, chat_id, items):
+    """Отправить напоминания одного чата, объединяя одновременные
+
+    items — [(event, minutes, occurrence, attempt)]. Напоминания,
+    сработавшие вместе, уходят одним сообщением; делим только
+    при превышении лимита длины сообщения.
+    """
+    pending = []
+    stale = []
+    # Старые события могут хранить одно напоминание дважды
+    seen = set()
+    stale_before = datetime.now(pytz.UTC) - CATCHUP_STALE_AFTER
+    for event, minutes, occurrence, attempt in items:
+        key = (event["id"], minutes, occurrence)
+        if key in seen:
+            continue
+        seen.add(key)
+        if is_delivered(event, minutes,
+                        occurrence) or store.is_parked(chat_id):
+            store.drop_retry(retry_key(event, minutes, occurrence))
+            continue
+        if occurrence - timedelta(minutes=minutes) < stale_before:
+            stale.append((event, minutes, occurrence, attempt))
+        else:
+            pending.append((event, minutes, occurrence, attempt))
+
+    # (текст, напоминания, это сводка пропущенных)
+    chunks = [(text, chunk, False) for text, chunk in pack_reminders(pending)]
+    if stale:
+        chunks.insert(0, (format_missed_summary(stale), stale, True))
+
+    for text, chunk, missed in chunks:
+        if store.is_parked(chat_id):
+            for event, minutes, occurrence, attempt in chunk:
+                store.drop_retry(retry_key(event, minutes, occurrence))
+            continue
+        await _send_chunk(bot, chat_id, text, chunk, missed)
+
+
+async def _send_chunk(bot,
+                      chat_id,
+                      text,
+                      chunk,
+                      missed=False,
+                      parse_mode="Markdown"):
+    try:
+        await rate_limiter.acquire(chat_id)
+        # События, удалённые пока сообщение ждало очереди, не отправляем
+        live = [item for item in chunk if store.get(item[0]["id"])]
+        if not live:
+            return
+        if len(live) != len(chunk):
+            text = render_chunk(live, missed)
+            chunk = live
+        started = time.perf_counter()
+        try:
+            await bot.send_message(chat_id, text, parse_mode=parse_mode)
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started)
+    except RetryAfter as ex:
+        SEND_FAILURES.inc(reason="retry_after")
+        print(f"⏸️ RetryAfter {ex.retry_after} s for chat {chat_id}")
+        rate_limiter.pause(chat_id, ex.retry_after)
+        for event, minutes, occurrence, attempt in chunk:
+            if not delivery_queue.retry(event, minutes, occurrence, attempt,
+                                        ex.retry_after):
+                store.drop_retry(retry_key(event, minutes, occurrence))
+        return
+    except ChatMigrated as ex:
+        SEND_FAILURES.inc(reason="migrated")
+        moved = store.migrate_chat(chat_id, ex.new_chat_id)
+        print(f"🔀 Chat {chat_id} migrated to {ex.new_chat_id}, "
+              f"moved {moved} events")
+        await _send_chunk(bot, ex.new_chat_id, text, chunk, missed, parse_mode)
+        return
+    except Forbidden as ex:
+        SEND_FAILURES.inc(reason="forbidden")
+        print(f"🅿️ Parking chat {chat_id}: {ex}")
+        store.park_chat(chat_id, str(ex))
+        for event, minutes, occurrence, attempt in chunk:
+            store.drop_retry(retry_key(event, minutes, occurrence))
+        return
+    except BadRequest as ex:
+        SEND_FAILURES.inc(reason="bad_request")
+        if "chat not found" in str(ex).lower():
+            print(f"🅿️ Parking chat {chat_id}: {ex}")
+            store.park_chat(chat_id, str(ex))
+        elif "can't parse entities" in str(ex).lower() and parse_mode:
+            # Разметка одного напоминания не должна топить остальные:
+            # шлём по одному, а не разобравшееся — простым текстом
+            print(f"⚠️ Markdown rejected for chat {chat_id}, resending: {ex}")
+            if len(chunk) > 1:
+                for item in chunk:
+                    single = render_chunk([item], missed)
+                    await _send_chunk(bot, chat_id, single, [item], missed)
+            else:
+                await _send_chunk(bot, chat_id, text, chunk, missed, None)
+            return
+        else:
+            # Ошибка в самом сообщении: повтор не поможет
+            print(f"❌ Error sending reminder: {ex}")
+        for event, minutes, occurrence, attempt in chunk:
+            store.drop_retry(retry_key(event, minutes, occurrence))
+        return
+    except Exception as ex:
+        SEND_FAILURES.inc(reason="error")
+        # Одна пауза на всё сообщение: при повторе оно снова уйдёт целиком
+        delay = retry_delay(max(item[3] for item in chunk))
+        for event, minutes, occurrence, attempt in chunk:
+            if delivery_queue.retry(event, minutes, occurrence, attempt,
+                                    delay):
+                print(f"🔁 Error sending reminder (attempt {attempt + 1}), "
+                      f"will retry: {ex}")
+            else:
+                print(f"❌ Giving up on reminder after {attempt + 1} "
+                      f"attempts: {ex}")
+                store.drop_retry(retry_key(event, minutes, occurrence))
+        return
+
+    sent_at = datetime.now(pytz.UTC)
+    for event, minutes, occurrence, attempt in chunk:
+        store.drop_retry(retry_key(event, minutes, occurrence))
+        store.mark_delivered(event, minutes, occurrence)
+        REMINDERS_SENT.inc()
+        fire_at = occurrence - timedelta(minutes=minutes)
+        lag = (sent_at - fire_at).total_seconds()
+        DELIVERY_LAG.observe(lag)
+        health.record_lag(lag)
+        print(
+            f"✅ Sent reminder for '{event['title']}' ({minutes} min) to chat {chat_id}"
+        )
+
+
+# Заходы в отправку по порядку: [до какого момента, незавершённых задач]
+_watermark_pending = deque()
+
+
+def track_watermark(until, tasks):
+    """Сдвинуть watermark до until, когда задачи захода завершатся
+
+    Watermark продвигается строго по порядку заходов, поэтому после
+    перезапуска досылается всё, что не было передано в отправку
+    или в очередь повторов.
+    """
+    entry = [until, len(tasks)]
+    _watermark_pending.append(entry)
+
+    def done(task):
+        entry[1] -= 1
+        _advance_watermark()
+
+    for task in tasks:
+        task.add_done_callback(done)
+    _advance_watermark()
+
+
+def _advance_watermark():
+    while _watermark_pending and _watermark_pending[0][1] <= 0:
+        store.set_watermark(_watermark_pending.popleft()[0].timestamp())
+
+
+async def catch_up(bot, since, now):
+    """Дослать напоминания, пропущенные пока бот не работал"""
+    until = now - timedelta(seconds=REMINDER_GRACE)
+    missed = missed_reminders(list(store.events), since, until)
+    if not missed:
+        return
+    print(f"⏪ Catching up {len(missed)} missed reminders since "
+          f"{since.strftime('%Y-%m-%d %H:%M:%S')} UTC")
+
+    # Пачками: следующая пачка уходит, когда отправлена предыдущая
+    for start in range(0, len(missed), CATCHUP_BATCH):
+        tasks = dispatch_reminders(bot, missed[start:start + CATCHUP_BATCH])
+        await asyncio.gather(*tasks, return_exceptions=True)
+    print("⏪ Catch-up complete")
 
 
 async def check_reminders(application):
@@ -748,83 +2675,36 @@ async def check_reminders(application):
     bot = application.bot
     print("🔔 Reminder checker started!")
 
+    now = datetime.now(pytz.UTC)
+    if store.watermark:
+        since = datetime.fromtimestamp(store.watermark, pytz.UTC)
+        task = asyncio.create_task(catch_up(bot, since, now))
+        _delivery_tasks.add(task)
+        task.add_done_callback(_delivery_tasks.discard)
+        track_watermark(now - timedelta(seconds=REMINDER_GRACE), [task])
+    else:
+        store.set_watermark(now.timestamp())
+
     while True:
+        health.beat("scheduler")
         try:
             now = datetime.now(pytz.UTC)
-            data = load_data()
 
-            now_moscow = now.astimezone(TIMEZONE)
-            print(
-                f"⏰ Checking reminders at {now_moscow.strftime('%Y-%m-%d %H:%M:%S')} MSK"
-            )
-
-            for event in data.get("events", []):
-                try:
-                    if "event_time" not in event or "notify_minutes" not in event:
-                        continue
-
-                    repeat_type = event.get("repeat", "once")
-                    next_occurrence = get_next_occurrence(
-                        event["event_time"], repeat_type)
-
-                    if not next_occurrence:
-                        continue
-
-                    if "sent_notifications" not in event:
-                        event["sent_notifications"] = []
-
-                    for minutes in event["notify_minutes"]:
-                        notify_time = next_occurrence - timedelta(
-                            minutes=minutes)
-                        time_diff = (notify_time - now).total_seconds()
-
-                        notification_key = f"{next_occurrence.isoformat()}_{minutes}"
-
-                        if -45 < time_diff < 45 and notification_key not in event[
-                                "sent_notifications"]:
-                            try:
-                                event_local = next_occurrence.astimezone(
-                                    TIMEZONE)
-
-                                if minutes == 0:
-                                    message = f"⏰ *Событие началось!*\n\n📝 {event['title']}\n🕐 {event_local.strftime('%H:%M')}"
-                                elif minutes < 60:
-                                    message = f"⏰ *Напоминание*\n\n📝 {event['title']}\n⏱ Через {minutes} мин\n🕐 Событие в {event_local.strftime('%H:%M')}"
-                                elif minutes < 1440:
-                                    hours = minutes // 60
-                                    message = f"⏰ *Напоминание*\n\n📝 {event['title']}\n⏱ Через {hours} ч\n🕐 Событие в {event_local.strftime('%H:%M')}"
-                                else:
-                                    days = minutes // 1440
-                                    message = f"⏰ *Напоминание*\n\n📝 {event['title']}\n⏱ Через {days} д\n📅 Событие {event_local.strftime('%d.%m в %H:%M')}"
-
-                                await bot.send_message(event["chat_id"],
-                                                       message,
-                                                       parse_mode="Markdown")
-
-                                event["sent_notifications"].append(
-                                    notification_key)
-                                save_data(data)
-
-                                print(
-                                    f"✅ Sent reminder for '{event['title']}' ({minutes} min) to chat {event['chat_id']}"
-                                )
-                            except Exception as ex:
-                                print(f"❌ Error sending reminder: {ex}")
-
-                    if event.get("sent_notifications"):
-                        cutoff = (now - timedelta(days=2)).isoformat()
-                        event["sent_notifications"] = [
-                            n for n in event["sent_notifications"]
-                            if n.split("_")[0] > cutoff
-                        ]
-
-                except Exception as e:
-                    print(
-                        f"❌ Error processing event '{event.get('title', 'Unknown')}': {e}"
-                    )
-                    continue
-
-            await asyncio.sleep(30)
+            # Забираем и то, что сработает в ближайшие секунды, чтобы
+            # объединить одновременные напоминания чата в одно сообщение
+            until = now + COALESCE_WINDOW
+            started = time.perf_counter()
+            due = scheduler.pop_due(until)
+            tasks = dispatch_reminders(bot,
+                                       [(event, minutes, occurrence, 0)
+                                        for event, minutes, occurrence in due])
+            track_watermark(until, tasks)
+            TICK_SECONDS.observe(time.perf_counter() - started)
+            DUE_ITEMS.set(len(due))
+
+            # Спим до следующего напоминания, но не дольше интервала
+            # отметок живости
+            await scheduler.wait_next(HEARTBEAT_INTERVAL)
         except Exception as e:
             print(f"❌ Error in check_reminders: {e}")
             import traceback
@@ -832,24 +2712,299 @@ async def check_reminders(application):
             await asyncio.sleep(30)
 
 
-# ============= KEEP ALIVE (против засыпания) =============
+# ============= АРХИВ =============
+
+# Через сколько дней после события разовое событие уходит в архив
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "7"))
+ARCHIVE_INTERVAL = 3600
+HISTORY_LIMIT = 20
+
+
+class EventArchive:
+    """Архив завершённых событий: сжатые сегменты по месяцам
+
+    Каждый запуск архивации дописывает в сегмент новый gzip-член
+    с JSON-строками событий; gzip читает такие файлы целиком.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def segment_path(self, dt):
+        return os.path.join(self.directory,
+                            f"events-{dt.strftime('%Y-%m')}.jsonl.gz")
+
+    def append(self, events, now):
+        """Дописать события в сегмент текущего месяца"""
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self.segment_path(now), "at", encoding="utf-8") as f:
+            for event in events:
+                f.write(
+                    json.dumps(event,
+                               ensure_ascii=False,
+                               separators=(",", ":")))
+                f.write("\n")
+
+    def query(self, chat_id, limit=HISTORY_LIMIT):
+        """Последние архивные события чата, новые первыми"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = {}
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith(".jsonl.gz"):
+                continue
+            with gzip.open(os.path.join(self.directory, name),
+                           "rt",
+                           encoding="utf-8") as f:
+                for line in f:
+                    event = json.loads(line)
+                    if event.get("chat_id") == chat_id:
+                        found[event["id"]] = event
+            if len(found) >= limit:
+                break
+        events = sorted(found.values(),
+                        key=lambda e: e.get("event_at", 0),
+                        reverse=True)
+        return events[:limit]
+
+
+archive = EventArchive()
+
+
+def expired_events(now):
+    """Разовые события, прошедшие больше ARCHIVE_AFTER_DAYS назад"""
+    cutoff = int((now - timedelta(days=ARCHIVE_AFTER_DAYS)).timestamp())
+    return [
+        event for event in store.events
+        if event.get("repeat", "once") == "once"
+        and event.get("event_at", cutoff) < cutoff
+    ]
+
+
+async def archive_expired(now=None):
+    """Перенести завершённые разовые события из хранилища в архив"""
+    if now is None:
+        now = datetime.now(pytz.UTC)
+    expired = expired_events(now)
+    if not expired:
+        return 0
 
+    # Сначала надёжно пишем архив, потом удаляем из хранилища:
+    # при сбое между шагами событие окажется в архиве дважды, но не пропадёт
+    await store.run_io(archive.append, [dict(e) for e in expired], now)
+    for event in expired:
+        store.delete(event["id"])
+        scheduler.remove_event(event["id"])
+    print(f"🗄️ Archived {len(expired)} expired events")
+    return len(expired)
 
-async def keep_alive(application):
-    """Периодический пинг чтобы Replit не засыпал"""
-    print("💚 Keep-alive started!")
 
+async def retention_loop():
+    """Фоновая архивация прошедших событий"""
     while True:
         try:
-            await asyncio.sleep(1800)  # Каждые 30 минут
+            await archive_expired()
+        except Exception as e:
+            print(f"❌ Error archiving events: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+# ============= ЗДОРОВЬЕ =============
+
+# Период отметок живости фоновых задач (секунды)
+HEARTBEAT_INTERVAL = 30
+# Отметка старше этого — задача зависла
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+# Event loop не отвечает дольше этого — он заблокирован (секунды)
+LOOP_STALL_SECONDS = float(os.environ.get("LOOP_STALL_SECONDS", "10"))
+# Опоздание доставки, после которого бот считается degraded (секунды)
+DELIVERY_LAG_DEGRADED = float(os.environ.get("DELIVERY_LAG_DEGRADED", "60"))
+# За какое время учитываются опоздания и зависания (секунды)
+HEALTH_WINDOW = 300
+# Период проверки связи с Telegram (секунды)
+TELEGRAM_PROBE_INTERVAL = 300
+# Предельная пауза перед перезапуском упавшей задачи (секунды)
+RESTART_MAX_DELAY = 60
+
+
+class HealthMonitor:
+    """Живость бота: отметки задач, зависания loop, перезапуски
+
+    Фоновые задачи запускаются через supervise() и поднимаются заново,
+    если упали. Отдельный поток следит, что event loop отвечает.
+    """
+
+    def __init__(self):
+        # name -> (monotonic последней отметки, допустимый интервал)
+        self.beats = {}
+        self.tasks = {}
+        self.restarts = {}
+        # (monotonic, опоздание) недавних доставок
+        self.lags = deque(maxlen=1000)
+        self.loop_seen = time.monotonic()
+        self.last_stall = None
+        self.stalled = False
+        self.started = False
+        self._loop_thread = None
+
+    def beat(self, name, timeout=HEARTBEAT_TIMEOUT):
+        """Отметка живости задачи"""
+        self.beats[name] = (time.monotonic(), timeout)
+
+    def supervise(self, name, factory, heartbeat=False):
+        """Запустить фоновую задачу и перезапускать её при падении"""
+        if heartbeat:
+            self.beat(name)
+        task = asyncio.create_task(self._run(name, factory))
+        self.tasks[name] = task
+        return task
+
+    async def _run(self, name, factory):
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await factory()
+                print(f"⚠️ Background task {name} exited, restarting")
+            except Exception as e:
+                print(f"❌ Background task {name} crashed: {e}")
+                import traceback
+                traceback.print_exc()
+            # Задача долго работала — паузы перед перезапуском с начала
+            if time.monotonic() - started > RESTART_MAX_DELAY:
+                failures = 0
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+            TASK_RESTARTS.inc(task=name)
+            await asyncio.sleep(min(2**failures, RESTART_MAX_DELAY))
+            failures += 1
+
+    def record_lag(self, lag):
+        """Учесть опоздание доставки напоминания (секунды)"""
+        self.lags.append((time.monotonic(), lag))
+
+    def loop_tick(self, lag):
+        """Event loop отозвался; lag — на сколько опоздал его sleep"""
+        now = time.monotonic()
+        self._loop_thread = threading.get_ident()
+        if lag > LOOP_STALL_SECONDS:
+            self.last_stall = now
+        if self.stalled:
+            self.stalled = False
+            print(f"💚 Event loop responsive again after "
+                  f"{now - self.loop_seen:.1f} s")
+        self.loop_seen = now
+
+    def start_watchdog(self):
+        """Поток, который замечает заблокированный event loop"""
+        self.loop_seen = time.monotonic()
+        thread = threading.Thread(target=self._watch,
+                                  name="loop-watchdog",
+                                  daemon=True)
+        thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(LOOP_STALL_SECONDS / 2)
+            blocked = time.monotonic() - self.loop_seen
+            if blocked < LOOP_STALL_SECONDS or self.stalled:
+                continue
+            self.stalled = True
+            self.last_stall = time.monotonic()
+            print(f"🧊 Event loop blocked for {blocked:.0f} s")
+            # Где застрял loop: стек его потока
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                import traceback
+                traceback.print_stack(frame)
+
+    def status(self):
+        """Состояние: (starting | ok | degraded | fail, проверки)"""
+        now = time.monotonic()
+        checks = {}
+
+        blocked = now - self.loop_seen
+        recent_stall = (self.last_stall is not None
+                        and now - self.last_stall < HEALTH_WINDOW)
+        checks["event_loop"] = {
+            "status": ("fail" if blocked >= LOOP_STALL_SECONDS else
+                       "degraded" if recent_stall else "ok"),
+            "lag_p95":
+            round(LOOP_LAG.quantile(0.95), 3),
+        }
+
+        for name, task in self.tasks.items():
+            check = {
+                "status": "fail" if task.done() else "ok",
+                "restarts": self.restarts.get(name, 0),
+            }
+            if name in self.beats:
+                seen, timeout = self.beats[name]
+                check["last_beat"] = round(now - seen, 1)
+                if check["status"] == "ok" and now - seen > timeout:
+                    check["status"] = "degraded"
+            checks[name] = check
+
+        lags = [lag for at, lag in self.lags if now - at < HEALTH_WINDOW]
+        # Напоминание должно было уйти, но всё ещё в таблице
+        fire_at = scheduler.next_fire_at()
+        overdue = 0.0
+        if fire_at is not None:
+            overdue = max((datetime.now(pytz.UTC) - fire_at).total_seconds(),
+                          0)
+        worst = max(lags + [overdue])
+        checks["delivery"] = {
+            "status": "degraded" if worst > DELIVERY_LAG_DEGRADED else "ok",
+            "max_lag": round(worst, 1),
+            "retry_queue": len(delivery_queue),
+        }
+
+        statuses = {check["status"] for check in checks.values()}
+        if not self.started:
+            status = "starting"
+        elif "fail" in statuses:
+            status = "fail"
+        elif "degraded" in statuses:
+            status = "degraded"
+        else:
+            status = "ok"
+        return status, checks
+
 
-            # Просто проверяем что бот жив
-            me = await application.bot.get_me()
-            print(f"💚 Keep-alive ping: Bot @{me.username} is alive!")
+health = HealthMonitor()
 
+
+async def probe_telegram(bot):
+    """Периодическая проверка связи с Bot API"""
+    while True:
+        try:
+            await bot.get_me()
+            health.beat("telegram", 2 * TELEGRAM_PROBE_INTERVAL)
         except Exception as e:
-            print(f"❌ Keep-alive error: {e}")
-            await asyncio.sleep(1800)
+            print(f"❌ Telegram API check failed: {e}")
+        await asyncio.sleep(TELEGRAM_PROBE_INTERVAL)
+
+
+def _health_response(ok, status, checks):
+    body = json.dumps({"status": status, "checks": checks}, ensure_ascii=False)
+    return 200 if ok else 503, body, "application/json"
+
+
+async def health_request(request):
+    """Полная сводка: 503, если бот не запущен или сломан"""
+    status, checks = health.status()
+    return _health_response(status in ("ok", "degraded"), status, checks)
+
+
+async def liveness_request(request):
+    """Живость: перезапускать процесс стоит только при fail"""
+    status, checks = health.status()
+    return _health_response(status != "fail", status, checks)
+
+
+async def readiness_request(request):
+    """Готовность: напоминания уходят вовремя"""
+    status, checks = health.status()
+    return _health_response(status == "ok", status, checks)
 
 
 # ============= ОБРАБОТКА ОШИБОК =============
@@ -869,6 +3024,317 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
 
+# ============= ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА =============
+
+# Сколько обновлений обрабатывать одновременно (1 — строго по очереди)
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов
+
+    Обновления одного чата (и одного пользователя вне чатов) выполняются
+    строго по очереди, поэтому шаги диалога в user_data и правки одних и
+    тех же событий не перемешиваются. Разные чаты обслуживаются
+    параллельно, не больше limit одновременно.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # Семафор PTB берётся ещё до замка чата: обновления, ждущие своей
+        # очереди в одном занятом чате, заняли бы все слоты. Поэтому его
+        # не ограничиваем, а свой лимит применяем уже под замком чата
+        super().__init__(sys.maxsize if max_concurrent_updates > 1 else 1)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # ключ -> [замок, число ожидающих]
+        self._locks = {}
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ============= HTTP СЕРВЕР =============
+
+# Ответы HTTP сервера
+HTTP_STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+# Максимальный размер тела запроса (байты)
+HTTP_MAX_BODY = 4 * 1024 * 1024
+# Сколько держать простаивающее keep-alive соединение (секунды)
+HTTP_IDLE_TIMEOUT = 75
+# Максимальное число заголовков в запросе
+HTTP_MAX_HEADERS = 100
+
+
+class HttpError(Exception):
+    """Ошибка разбора запроса с HTTP кодом ответа"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpRequest:
+    """Разобранный HTTP запрос"""
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class HttpServer:
+    """Минимальный асинхронный HTTP/1.1 сервер на asyncio
+
+    Обработчик маршрута получает HttpRequest и возвращает
+    (код, тело) или (код, тело, тип содержимого).
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        print(f"🌐 HTTP server listening on {host}:{port}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        # Таймаут на весь запрос, а не на строку: клиент, присылающий
+        # заголовки по байту, не удержит соединение дольше простоя
+        return await asyncio.wait_for(self._parse_request(reader),
+                                      HTTP_IDLE_TIMEOUT)
+
+    async def _parse_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise HttpError(400, "bad request line")
+
+        headers = {}
+        for count in range(HTTP_MAX_HEADERS + 1):
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Строка длиннее буфера потока
+                raise HttpError(431, "header too long")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if count == HTTP_MAX_HEADERS:
+                raise HttpError(431, "too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(400, "bad content-length")
+        if length > HTTP_MAX_BODY:
+            raise HttpError(413, "payload too large")
+        body = await reader.readexactly(length) if length else b""
+
+        if version == "HTTP/1.0" or headers.get("connection",
+                                                "").lower() == "close":
+            headers["connection"] = "close"
+        return HttpRequest(method, target.split("?")[0], headers, body)
+
+    async def _respond(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if not handler:
+            if any(path == request.path for _, path in self.routes):
+                return 405, "method not allowed"
+            return 404, "not found"
+        try:
+            return await handler(request)
+        except Exception as e:
+            print(f"❌ HTTP handler error {request.path}: {e}")
+            return 500, "internal error"
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as e:
+                    writer.write(self._format(e.status, str(e), close=True))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                keep_alive = request.headers.get("connection") != "close"
+                writer.write(
+                    self._format(*await self._respond(request),
+                                 close=not keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # Остановка сервера при открытом соединении: просто закрываем
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _format(status, body, content_type="text/plain", close=False):
+        if isinstance(body, str):
+            body = body.encode()
+        head = (f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+        return head.encode() + body
+
+
+# ============= WEBHOOK =============
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Публичный адрес webhook для setWebhook (пусто — не регистрировать)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(
+    os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8080")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+
+class WebhookServer(HttpServer):
+    """Приём обновлений по HTTP
+
+    Тело запроса — одно обновление Telegram или JSON массив обновлений
+    (пакетная доставка для локальной подачи, тестов и нагрузочных прогонов).
+    Обновления кладутся в очередь приложения, ответ отдаётся сразу.
+    """
+
+    def __init__(self, application, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        super().__init__()
+        self.application = application
+        self.secret = secret
+        self.received = 0
+        self.route("POST", path, self.handle_webhook)
+
+    async def inject(self, payload):
+        """Поставить обновление (dict) или список обновлений в обработку"""
+        items = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(item, dict) for item in items):
+            raise TypeError("update must be a JSON object")
+        updates = [
+            Update.de_json(item, self.application.bot) for item in items
+        ]
+        for update in updates:
+            await self.application.update_queue.put(update)
+        self.received += len(updates)
+        return len(updates)
+
+    async def handle_webhook(self, request):
+        if self.secret:
+            token = request.headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token.encode(), self.secret.encode()):
+                return 403, "forbidden"
+
+        try:
+            payload = json.loads(request.body)
+            await self.inject(payload)
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"⚠️ Bad webhook payload: {e}")
+            return 400, "bad request"
+        return 200, "ok"
+
+
+async def run_webhook(application):
+    """Работа через webhook: свой HTTP сервер вместо long polling"""
+    secret = WEBHOOK_SECRET
+    listen = WEBHOOK_LISTEN
+    if WEBHOOK_URL and not secret:
+        secret = secrets.token_urlsafe(32)
+    elif not secret:
+        # Без секрета кто угодно может прислать обновление от имени
+        # любого пользователя, поэтому принимаем их только с этой машины
+        listen = "127.0.0.1"
+        print("⚠️ WEBHOOK_SECRET is not set, accepting unverified updates "
+              "on 127.0.0.1 only")
+    server = WebhookServer(application, WEBHOOK_PATH, secret)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        await server.start(listen, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(WEBHOOK_URL,
+                                              secret_token=secret,
+                                              allowed_updates=Update.ALL_TYPES)
+            print(f"🔗 Webhook registered: {WEBHOOK_URL}")
+
+        try:
+            await stop.wait()
+        finally:
+            await server.close()
+            await application.stop()
+    await application.post_shutdown(application)
+
+
 # ============= ИНИЦИАЛИЗАЦИЯ =============
 
 
@@ -878,30 +3344,79 @@ async def post_init(application):
         BotCommand("menu", "Главное меню бота"),
         BotCommand("cancel", "Отменить текущее действие"),
         BotCommand("help", "Справка по использованию"),
+        BotCommand("history", "Архив прошедших событий"),
         BotCommand("debug", "Отладочная информация"),
     ]
     await application.bot.set_my_commands(commands)
 
-    # Запуск фоновых задач
-    asyncio.create_task(check_reminders(application))
-    asyncio.create_task(keep_alive(application))
+    # Группы, припаркованные при переходе в супергруппу до того,
+    # как события научились переезжать за ней
+    for chat_id, reason in list(store.data.get("parked_chats", {}).items()):
+        if "New chat id: " in reason:
+            store.migrate_chat(int(chat_id), int(reason.rsplit(" ", 1)[1]))
+
+    scheduler.rebuild(store.events)
+    delivery_queue.load()
+
+    # Запуск фоновых задач (упавшие перезапускаются)
+    bot = application.bot
+    health.supervise("scheduler",
+                     lambda: check_reminders(application),
+                     heartbeat=True)
+    health.supervise("dispatcher",
+                     lambda: delivery_queue.run(bot),
+                     heartbeat=True)
+    health.supervise("horizon", extend_horizon)
+    health.supervise("retention", retention_loop)
+    health.supervise("telegram", lambda: probe_telegram(bot))
+    health.supervise("loop_lag", measure_loop_lag)
+    health.start_watchdog()
+
+    if METRICS_PORT:
+        server = HttpServer()
+        server.route("GET", "/metrics", metrics_request)
+        server.route("GET", "/health", health_request)
+        server.route("GET", "/health/live", liveness_request)
+        server.route("GET", "/health/ready", readiness_request)
+        try:
+            await server.start(METRICS_LISTEN, METRICS_PORT)
+        except OSError as e:
+            print(f"⚠️ Metrics endpoint not started: {e}")
 
+    health.started = True
     print("✅ Bot initialization complete!")
 
 
+async def post_shutdown(application):
+    """Сохранение несохранённых данных при остановке"""
+    await store.close()
+    print("💾 Data flushed to disk")
+
+
 # ============= ЗАПУСК =============
 
 
 def main():
-    application = Application.builder().token(TOKEN).post_init(
-        post_init).build()
+    started = time.perf_counter()
+    store.load()
+    STORE_LOAD_SECONDS.set(round(time.perf_counter() - started, 6))
+
+    builder = Application.builder().token(TOKEN).concurrent_updates(
+        ChatUpdateProcessor(UPDATE_CONCURRENCY)).post_init(
+            post_init).post_shutdown(post_shutdown)
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("menu", menu))
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("help", help_menu))
+    application.add_handler(CommandHandler("history", history))
     application.add_handler(CommandHandler("debug", debug_info))
     application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(
+        MessageHandler(filters.StatusUpdate.MIGRATE, chat_migrated))
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
@@ -910,9 +3425,13 @@ def main():
 
     print("🤖 Bot started!")
     print(f"🕐 Timezone: {TIMEZONE}")
+    print(f"📡 Mode: {BOT_MODE}")
     print("=" * 50)
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+import uuid
+
+import main
+
+
+def test_short_id_round_trip():
+    for event_id in [str(uuid.uuid4()) for _ in range(200)] + [
+            "00000000-0000-0000-0000-000000000000",
+            "ffffffff-ffff-ffff-ffff-ffffffffffff",
+    ]:
+        short = main.short_id(event_id)
+        assert len(short) <= 22
+        assert main.CALLBACK_SEPARATOR not in short
+        assert main.full_id(short) == event_id
+
+
+def test_short_id_keeps_non_uuid_ids():
+    assert main.full_id(main.short_id("event-1")) == "event-1"
+    assert main.full_id(main.short_id("42")) == "42"
+
+
+def test_button_data_fits_telegram_limit():
+    event_id = "ffffffff-ffff-ffff-ffff-ffffffffffff"
+    data = main.button_data(main.CB_DELETE, main.short_id(event_id))
+    assert len(data.encode()) <= 64
+
+    code, args = main.parse_callback(data)
+    assert code == main.CB_DELETE
+    assert main.full_id(args[0]) == event_id
+
+
+def test_legacy_delete_callback():
+    event_id = str(uuid.uuid4())
+    code, args = main.parse_callback(f"del_{event_id}")
+    assert code == main.CB_DELETE
+    assert main.full_id(args[0]) == event_id
+
+
+def test_legacy_callbacks():
+    assert main.parse_callback("main_menu") == (main.CB_MAIN_MENU, [])
+    assert main.parse_callback("notify_custom") == (main.CB_NOTIFY_CUSTOM, [])
+    assert main.parse_callback("notify_60") == (main.CB_NOTIFY, ["60"])
+    assert main.parse_callback("listpage_2") == (main.CB_LIST, ["2"])
+    assert main.parse_callback("repeat_weekly") == (main.CB_REPEAT, ["weekly"])
+
+
+def test_every_code_has_a_route():
+    codes = {
+        value
+        for name, value in vars(main).items() if name.startswith("CB_")
+    }
+    assert codes == set(main.CALLBACK_ROUTES)
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+
+import main
+
+UTC = pytz.UTC
+
+
+def at(*args):
+    return UTC.localize(datetime(*args))
+
+
+def make_event(event_id, event_at, chat_id=1, **fields):
+    event = {
+        "id": event_id,
+        "chat_id": chat_id,
+        "title": f"Событие {event_id}",
+        "event_at": int(event_at.timestamp()),
+        "repeat": "once",
+        "notify_minutes": [0],
+        "created_by": 1,
+    }
+    event.update(fields)
+    return event
+
+
+def test_missed_one_off_inside_gap():
+    since, until = at(2026, 3, 1, 10, 0), at(2026, 3, 1, 12, 0)
+    inside = make_event("in", at(2026, 3, 1, 11, 0), notify_minutes=[0, 30])
+    before = make_event("before", at(2026, 3, 1, 9, 0))
+    after = make_event("after", at(2026, 3, 1, 13, 0))
+
+    missed = main.missed_reminders([inside, before, after], since, until)
+
+    # По времени срабатывания: сначала за 30 минут, потом в момент события
+    order = [(e["id"], minutes) for e, minutes, _, _ in missed]
+    assert order == [("in", 30), ("in", 0)]
+    assert all(occurrence == at(2026, 3, 1, 11, 0)
+               for _, _, occurrence, _ in missed)
+
+
+def test_missed_recurring_keeps_last_occurrence():
+    since, until = at(2026, 3, 1, 10, 0), at(2026, 3, 4, 10, 0)
+    event = make_event("daily", at(2026, 2, 1, 9, 0), repeat="daily")
+
+    missed = main.missed_reminders([event], since, until)
+
+    # Пропущены повторения 2, 3 и 4 марта, напоминаем только о последнем
+    assert [occurrence
+            for _, _, occurrence, _ in missed] == [at(2026, 3, 4, 9, 0)]
+
+
+def test_missed_skips_delivered():
+    since, until = at(2026, 3, 1, 10, 0), at(2026, 3, 1, 12, 0)
+    event = make_event("in", at(2026, 3, 1, 11, 0), notify_minutes=[0, 30])
+    event["delivered"] = {"30": event["event_at"]}
+
+    missed = main.missed_reminders([event], since, until)
+
+    assert [minutes for _, minutes, _, _ in missed] == [0]
+
+
+def test_missed_ignores_time_before_event_was_created():
+    since, until = at(2026, 3, 1, 10, 0), at(2026, 3, 1, 12, 0)
+    # Создано в 11:10 на 11:30 с напоминанием за час: оно сработало бы
+    # в 10:30, когда события ещё не было
+    created = at(2026, 3, 1, 11, 10).replace(tzinfo=None).isoformat()
+    late = make_event("late",
+                      at(2026, 3, 1, 11, 30),
+                      notify_minutes=[0, 60],
+                      created_at=created)
+    daily = make_event("daily",
+                       at(2026, 2, 1, 10, 30),
+                       repeat="daily",
+                       created_at=created)
+
+    missed = main.missed_reminders([late, daily], since, until)
+
+    # Разовое: только напоминание в момент события. Ежедневное 10:30
+    # прошло до создания, а следующее — уже после until
+    assert [(e["id"], minutes) for e, minutes, _, _ in missed] == [("late", 0)]
+
+
+def send(items, monkeypatch):
+    """Прогнать send_reminders и вернуть отправленные части"""
+    sent = []
+
+    async def fake_send_chunk(bot, chat_id, text, chunk, missed=False):
+        sent.append(
+            (missed, [(e["id"], minutes) for e, minutes, _, _ in chunk]))
+
+    monkeypatch.setattr(main, "store", main.EventStore())
+    monkeypatch.setattr(main, "_send_chunk", fake_send_chunk)
+    asyncio.run(main.send_reminders(None, 1, items))
+    return sent
+
+
+def test_stale_reminders_go_to_summary(monkeypatch):
+    now = datetime.now(UTC)
+    stale_at = now - main.CATCHUP_STALE_AFTER - timedelta(minutes=5)
+    recent_at = now - timedelta(minutes=5)
+    stale = make_event("stale", stale_at)
+    recent = make_event("recent", recent_at)
+
+    sent = send([(stale, 0, stale_at, 0), (recent, 0, recent_at, 0)],
+                monkeypatch)
+
+    # Сначала сводка опоздавших, затем обычное напоминание
+    assert sent == [(True, [("stale", 0)]), (False, [("recent", 0)])]
+
+
+def test_delivered_reminders_are_not_resent(monkeypatch):
+    now = datetime.now(UTC)
+    fire_at = now - timedelta(minutes=5)
+    event = make_event("done", fire_at)
+    event["delivered"] = {"0": event["event_at"]}
+
+    assert send([(event, 0, fire_at, 0)], monkeypatch) == []
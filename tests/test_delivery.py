@@ -0,0 +1,291 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+import pytz
+from telegram import Update
+
+import main
+
+OCCURRENCE = pytz.UTC.localize(datetime(2026, 3, 1, 9, 0))
+
+
+class Clock:
+    """Подменное time.monotonic для корзин"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_event(event_id, chat_id=1):
+    return {
+        "id": event_id,
+        "chat_id": chat_id,
+        "title": f"Событие {event_id}",
+        "event_at": int(OCCURRENCE.timestamp()),
+        "repeat": "once",
+        "notify_minutes": [0],
+        "created_by": 1,
+    }
+
+
+def use_store(monkeypatch, tmp_path):
+    store = main.EventStore(str(tmp_path / "events.json"))
+    monkeypatch.setattr(main, "store", store)
+    return store
+
+
+# ============= ОГРАНИЧЕНИЕ ОТПРАВКИ =============
+
+
+def test_token_bucket_queues_reservations(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    bucket = main.TokenBucket(10, 1)
+
+    # Первый маркер сразу, следующие — в очередь по 0.1 с
+    delays = [bucket.reserve() for _ in range(3)]
+    assert delays == pytest.approx([0.0, 0.1, 0.2])
+    assert not bucket.idle()
+
+    clock.now += 0.31
+    assert bucket.wait_time() == 0.0
+    assert bucket.idle()
+
+
+def test_token_bucket_refill_is_capped(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    bucket = main.TokenBucket(1, 3)
+    for _ in range(3):
+        bucket.consume()
+    assert bucket.wait_time() == 1.0
+
+    # За долгий простой копится не больше capacity маркеров
+    clock.now += 60
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.0, 1.0]
+
+
+def test_limiter_spaces_sends_to_one_chat():
+    limiter = main.SendRateLimiter(global_rate=1000, chat_rate=20)
+    sent = []
+
+    async def send(n):
+        await limiter.acquire(1)
+        sent.append((n, time.monotonic()))
+
+    async def run():
+        await asyncio.gather(*(send(n) for n in range(4)))
+
+    asyncio.run(run())
+
+    # Порядок сохраняется, между отправками не меньше 1/20 с
+    assert [n for n, _ in sent] == [0, 1, 2, 3]
+    gaps = [b - a for (_, a), (_, b) in zip(sent, sent[1:])]
+    assert min(gaps) >= 0.04
+    assert limiter.stats()["sent"] == 4
+    assert limiter.queued == 0
+
+
+def test_limiter_does_not_hold_other_chats():
+    limiter = main.SendRateLimiter(global_rate=1000, chat_rate=5)
+
+    async def run():
+        # Занимаем маркер чата 1, второй запрос к нему ждёт 0.2 с
+        await limiter.acquire(1)
+        busy = asyncio.create_task(limiter.acquire(1))
+        await asyncio.sleep(0)
+        waited = await limiter.acquire(2)
+        await busy
+        return waited
+
+    assert asyncio.run(run()) < 0.05
+
+
+def test_limiter_group_minute_limit():
+    limiter = main.SendRateLimiter(global_rate=1000,
+                                   chat_rate=1000,
+                                   group_per_minute=2)
+    lock, buckets = limiter._chat_limits(-100)
+    assert len(buckets) == 2
+    assert len(limiter._chat_limits(100)[1]) == 1
+
+    async def run():
+        await limiter.acquire(-100)
+        await limiter.acquire(-100)
+
+    asyncio.run(run())
+    # Запас в минуту исчерпан: третье сообщение — через 30 с
+    assert 29 < max(bucket.wait_time() for bucket in buckets) <= 30
+
+
+def test_limiter_pause_and_flood_control():
+    limiter = main.SendRateLimiter(global_rate=1000, chat_rate=1000)
+    limiter.pause(1, 0.2)
+    assert limiter._pause_left(1) > 0
+    assert limiter._pause_left(None) == 0
+
+    async def run():
+        started = time.monotonic()
+        await limiter.acquire(1)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.15
+
+    # RetryAfter от трёх разных чатов подряд — пауза для всех
+    for chat_id in (2, 3, 4):
+        limiter.pause(chat_id, 5)
+    assert limiter._pause_left(None) > 4
+
+
+# ============= ОЧЕРЕДЬ ПОВТОРОВ =============
+
+
+def test_retry_delay_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 1.0)
+    delays = [main.retry_delay(attempt) for attempt in range(12)]
+    assert delays[:3] == [
+        main.RETRY_BASE_DELAY, main.RETRY_BASE_DELAY * 2,
+        main.RETRY_BASE_DELAY * 4
+    ]
+    assert max(delays) == main.RETRY_MAX_DELAY
+    assert delays == sorted(delays)
+
+
+def test_retry_is_stored_and_restored(monkeypatch, tmp_path):
+    store = use_store(monkeypatch, tmp_path)
+    event = make_event("a")
+    store.add(event)
+    queue = main.DeliveryQueue()
+
+    assert queue.retry(event, 0, OCCURRENCE, 2, delay=30)
+    entry = store.retries()[0]
+    assert entry["key"] == main.retry_key(event, 0, OCCURRENCE)
+    assert entry["attempt"] == 3
+    assert entry["next_try"] > time.time() + 25
+
+    # После перезапуска очередь поднимается из хранилища
+    restored = main.DeliveryQueue()
+    restored.load()
+    assert len(restored) == 1
+
+
+def test_retry_gives_up_after_max_attempts(monkeypatch, tmp_path):
+    store = use_store(monkeypatch, tmp_path)
+    queue = main.DeliveryQueue()
+
+    attempt = main.RETRY_MAX_ATTEMPTS
+    assert not queue.retry(make_event("a"), 0, OCCURRENCE, attempt)
+    assert len(queue) == 0
+    assert store.retries() == []
+
+
+def test_retry_queue_dispatches_due_entries(monkeypatch, tmp_path):
+    store = use_store(monkeypatch, tmp_path)
+    dispatched = []
+    monkeypatch.setattr(main, "dispatch_reminders",
+                        lambda bot, items: dispatched.extend(items))
+    alive, deleted = make_event("alive"), make_event("deleted")
+    store.add(alive)
+    store.add(deleted)
+    queue = main.DeliveryQueue()
+
+    async def run():
+        task = asyncio.create_task(queue.run(None))
+        queue.retry(alive, 0, OCCURRENCE, 0, delay=0)
+        queue.retry(deleted, 0, OCCURRENCE, 0, delay=0)
+        queue.retry(alive, 60, OCCURRENCE, 0, delay=3600)
+        store.delete("deleted")
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+    # Наступивший повтор ушёл с номером попытки, повтор удалённого
+    # события выброшен, дальний ждёт своего времени
+    assert dispatched == [(alive, 0, OCCURRENCE, 1)]
+    keys = {entry["key"] for entry in store.retries()}
+    assert keys == {
+        main.retry_key(alive, 0, OCCURRENCE),
+        main.retry_key(alive, 60, OCCURRENCE)
+    }
+    assert len(queue) == 1
+
+
+# ============= ОБРАБОТКА ОБНОВЛЕНИЙ =============
+
+
+def make_update(update_id, chat_id):
+    return Update.de_json(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {
+                    "id": chat_id,
+                    "type": "private"
+                },
+                "text": "x",
+            },
+        }, None)
+
+
+def test_updates_of_one_chat_run_in_order():
+    processor = main.ChatUpdateProcessor(4)
+    order = []
+    active = {}
+    peak = {}
+    finished = {}
+
+    async def handle(update_id, chat_id, seconds):
+        active[chat_id] = active.get(chat_id, 0) + 1
+        peak[chat_id] = max(peak.get(chat_id, 0), active[chat_id])
+        await asyncio.sleep(seconds)
+        active[chat_id] -= 1
+        order.append((chat_id, update_id))
+        finished[(chat_id, update_id)] = time.monotonic()
+
+    async def run():
+        # Десять медленных обновлений одного чата и одно другого
+        jobs = [(n, 1, 0.05) for n in range(10)] + [(100, 2, 0)]
+        updates = [
+            processor.process_update(make_update(n, chat_id),
+                                     handle(n, chat_id, seconds))
+            for n, chat_id, seconds in jobs
+        ]
+        await asyncio.gather(*updates)
+
+    asyncio.run(run())
+
+    assert [n for chat_id, n in order if chat_id == 1] == list(range(10))
+    assert peak == {1: 1, 2: 1}
+    # Другой чат не ждёт очереди занятого
+    assert finished[(2, 100)] < finished[(1, 0)]
+    assert processor._locks == {}
+
+
+def test_update_limit_applies_across_chats():
+    processor = main.ChatUpdateProcessor(2)
+    running = 0
+    peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    async def run():
+        await asyncio.gather(
+            *(processor.process_update(make_update(n, n), handle())
+              for n in range(8)))
+
+    asyncio.run(run())
+    assert peak == 2
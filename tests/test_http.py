@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import main
+
+
+class FakeApplication:
+    bot = None
+
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+
+
+async def request(port, raw):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(raw)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def serve(server, raw):
+    """Отправить сырой запрос на сервер и вернуть ответ"""
+
+    async def run():
+        await server.start("127.0.0.1", 0)
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.wait_for(request(port, raw), 5)
+        finally:
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def post(body):
+    body = json.dumps(body).encode()
+    return (b"POST /telegram HTTP/1.1\r\nConnection: close\r\n"
+            b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+
+
+def test_webhook_accepts_batch():
+    application = FakeApplication()
+    server = main.WebhookServer(application, "/telegram", secret="")
+
+    response = serve(server, post([{"update_id": 1}, {"update_id": 2}]))
+
+    assert response.startswith(b"HTTP/1.1 200")
+    assert application.update_queue.qsize() == 2
+
+
+def test_webhook_rejects_non_object_batch_item():
+    application = FakeApplication()
+    server = main.WebhookServer(application, "/telegram", secret="")
+
+    response = serve(server, post([{"update_id": 1}, 5, "x"]))
+
+    assert response.startswith(b"HTTP/1.1 400")
+    assert application.update_queue.empty()
+
+
+def test_too_many_headers():
+    server = main.HttpServer()
+    headers = b"X-Pad: 1\r\n" * (main.HTTP_MAX_HEADERS + 1)
+
+    response = serve(server, b"GET / HTTP/1.1\r\n" + headers + b"\r\n")
+
+    assert response.startswith(b"HTTP/1.1 431")
+
+
+def test_slow_headers_time_out(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_IDLE_TIMEOUT", 0.3)
+    server = main.HttpServer()
+
+    # Строка запроса пришла, заголовки так и не дописаны: раньше таймаут
+    # действовал только на строку запроса и соединение висело бесконечно
+    response = serve(server, b"GET / HTTP/1.1\r\nX-Pad: 1")
+
+    assert response == b""
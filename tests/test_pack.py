@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytz
+
+import main
+
+OCCURRENCE = pytz.UTC.localize(datetime(2026, 3, 1, 9, 0))
+
+
+def make_event(event_id, title=None, **fields):
+    event = {
+        "id": event_id,
+        "chat_id": 1,
+        "title": title or f"Событие {event_id}",
+        "event_at": int(OCCURRENCE.timestamp()),
+        "repeat": "once",
+        "notify_minutes": [0],
+        "created_by": 1,
+    }
+    event.update(fields)
+    return event
+
+
+def test_pack_joins_reminders_into_one_message():
+    items = [(make_event(str(i)), 0, OCCURRENCE, 0) for i in range(3)]
+
+    chunks = main.pack_reminders(items)
+
+    assert len(chunks) == 1
+    text, chunk = chunks[0]
+    assert chunk == items
+    assert text.count(main.REMINDER_SEPARATOR) == 2
+    assert text == main.render_chunk(items)
+
+
+def test_pack_splits_at_message_limit():
+    # Три блока по ~1550 символов: два помещаются в 4096, третий — нет
+    items = [(make_event(str(i), title="x" * 1500), 0, OCCURRENCE, 0)
+             for i in range(5)]
+
+    chunks = main.pack_reminders(items)
+
+    assert [len(chunk) for text, chunk in chunks] == [2, 2, 1]
+    assert all(len(text) <= main.MESSAGE_LIMIT for text, chunk in chunks)
+    assert [item for text, chunk in chunks for item in chunk] == items
+
+
+def test_pack_truncates_single_oversized_reminder():
+    item = (make_event("big", title="x" * 5000), 0, OCCURRENCE, 0)
+
+    chunks = main.pack_reminders([item])
+
+    assert len(chunks) == 1
+    assert len(chunks[0][0]) == main.MESSAGE_LIMIT
+
+
+def test_repeated_offsets_sent_once(monkeypatch):
+    sent = []
+
+    async def fake_send_chunk(bot, chat_id, text, chunk, missed=False):
+        sent.append([minutes for event, minutes, _, _ in chunk])
+
+    monkeypatch.setattr(main, "store", main.EventStore())
+    monkeypatch.setattr(main, "_send_chunk", fake_send_chunk)
+    occurrence = datetime.now(pytz.UTC) + timedelta(minutes=60)
+    # Событие из старых данных с "60,60"
+    event = make_event("dup", notify_minutes=[60, 60])
+    items = [(event, 60, occurrence, 0), (event, 60, occurrence, 0)]
+
+    asyncio.run(main.send_reminders(None, 1, items))
+
+    assert sent == [[60]]
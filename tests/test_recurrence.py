@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+import main
+
+UTC = pytz.UTC
+MSK = main.TIMEZONE
+
+
+def local(*args):
+    """Местное (московское) время в UTC"""
+    return MSK.localize(datetime(*args)).astimezone(UTC)
+
+
+def test_add_months_clamps_to_month_end():
+    assert main.add_months(datetime(2025, 1, 31), 1) == datetime(2025, 2, 28)
+    assert main.add_months(datetime(2024, 1, 31), 1) == datetime(2024, 2, 29)
+    assert main.add_months(datetime(2025, 1, 31), 2) == datetime(2025, 3, 31)
+    assert main.add_months(datetime(2025, 1, 31), 3) == datetime(2025, 4, 30)
+
+
+def test_add_months_crosses_year():
+    assert main.add_months(datetime(2024, 11, 30), 3) == datetime(2025, 2, 28)
+    assert main.add_months(datetime(2024, 12, 15), 1) == datetime(2025, 1, 15)
+
+
+def test_monthly_31st_returns_to_31st_after_february():
+    event = local(2025, 1, 31, 10, 0)
+
+    feb = main.get_next_occurrence(event, "monthly", event)
+    assert feb == local(2025, 2, 28, 10, 0)
+    mar = main.get_next_occurrence(event, "monthly", feb)
+    assert mar == local(2025, 3, 31, 10, 0)
+    apr = main.get_next_occurrence(event, "monthly", mar)
+    assert apr == local(2025, 4, 30, 10, 0)
+
+
+def test_monthly_31st_in_leap_year():
+    event = local(2024, 1, 31, 10, 0)
+
+    feb = main.get_next_occurrence(event, "monthly", event)
+    assert feb == local(2024, 2, 29, 10, 0)
+    mar = main.get_next_occurrence(event, "monthly", feb)
+    assert mar == local(2024, 3, 31, 10, 0)
+
+
+def test_monthly_keeps_local_time_years_later():
+    event = local(2019, 5, 31, 9, 30)
+    now = local(2026, 2, 10, 12, 0)
+
+    occurrence = main.get_next_occurrence(event, "monthly", now)
+    assert occurrence == local(2026, 2, 28, 9, 30)
+
+
+def test_daily_event_years_old():
+    event = datetime(2019, 3, 5, 7, 30, tzinfo=UTC)
+    now = datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+
+    occurrence = main.get_next_occurrence(event, "daily", now)
+    assert occurrence == datetime(2026, 10, 19, 7, 30, tzinfo=UTC)
+
+
+def test_weekly_event_years_old_keeps_weekday():
+    event = datetime(2020, 1, 6, 18, 0, tzinfo=UTC)  # понедельник
+    now = datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+
+    occurrence = main.get_next_occurrence(event, "weekly", now)
+    assert occurrence == datetime(2026, 10, 19, 18, 0, tzinfo=UTC)
+    assert occurrence.weekday() == event.weekday()
+
+
+def test_occurrence_is_strictly_after_now():
+    event = datetime(2021, 6, 1, 8, 0, tzinfo=UTC)
+    now = datetime(2026, 10, 18, 8, 0, tzinfo=UTC)
+
+    for repeat, step in (("daily", timedelta(days=1)), ("weekly",
+                                                        timedelta(weeks=1))):
+        occurrence = main.get_next_occurrence(event, repeat, now)
+        assert now < occurrence <= now + step
+        assert (occurrence - event) % step == timedelta(0)
+
+
+def test_once_event():
+    event = datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+
+    before = event - timedelta(seconds=1)
+    assert main.get_next_occurrence(event, "once", before) == event
+    assert main.get_next_occurrence(event, "once", event) is None
+
+
+def test_iso_string_and_batch_agree():
+    now = datetime(2026, 10, 18, 12, 0, tzinfo=UTC)
+    items = [("2019-03-05T07:30:00", "daily", now),
+             ("2025-01-31T07:00:00+00:00", "monthly", now),
+             ("2020-01-01T00:00:00", "once", now)]
+
+    expected = [main.get_next_occurrence(*item) for item in items]
+    assert main.get_next_occurrences(items) == expected
+    assert expected[2] is None
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+import main
+
+NOW = pytz.UTC.localize(datetime(2026, 3, 1, 9, 0))
+
+
+def make_event(event_id, chat_id=1, hours=1):
+    return {
+        "id": event_id,
+        "chat_id": chat_id,
+        "title": f"Событие {event_id}",
+        "event_at": int((NOW + timedelta(hours=hours)).timestamp()),
+        "repeat": "once",
+        "notify_minutes": [0],
+        "created_by": 1,
+    }
+
+
+def use_store(monkeypatch, tmp_path):
+    store = main.EventStore(str(tmp_path / "events.json"))
+    monkeypatch.setattr(main, "store", store)
+    return store
+
+
+def test_upcoming_filters_by_chat(monkeypatch, tmp_path):
+    use_store(monkeypatch, tmp_path)
+    events = [make_event("a", hours=3), make_event("b", chat_id=2, hours=1)]
+    events.append(make_event("c", hours=2))
+    for event in events:
+        main.store.add(event)
+    scheduler = main.ReminderScheduler()
+    scheduler.rebuild(events, NOW)
+
+    rows = scheduler.upcoming(5, chat_id=1)
+
+    assert [event["id"] for _, event, _, _ in rows] == ["c", "a"]
+    assert len(scheduler.upcoming(2)) == 2
+
+
+def test_upcoming_skips_deleted_events(monkeypatch, tmp_path):
+    use_store(monkeypatch, tmp_path)
+    events = [make_event("a"), make_event("b", hours=2)]
+    for event in events:
+        main.store.add(event)
+    scheduler = main.ReminderScheduler()
+    scheduler.rebuild(events, NOW)
+
+    # Строки удалённого события ещё в куче, а самого события уже нет
+    main.store.delete("a")
+
+    assert [
+        event["id"] for _, event, _, _ in scheduler.upcoming(5, chat_id=1)
+    ] == ["b"]
+    assert len(scheduler.upcoming(5)) == 1
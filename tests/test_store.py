@@ -0,0 +1,217 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytz
+
+import main
+
+
+def make_event(event_id, chat_id=1, **fields):
+    event = {
+        "id": event_id,
+        "chat_id": chat_id,
+        "title": f"Событие {event_id}",
+        "event_at": 1790000000,
+        "repeat": "once",
+        "notify_minutes": [0, 60],
+        "created_by": 1,
+    }
+    event.update(fields)
+    return event
+
+
+def reopen(path):
+    store = main.EventStore(str(path))
+    store.load()
+    return store
+
+
+def test_journal_replay_restores_changes(tmp_path):
+    path = tmp_path / "events.json"
+    store = reopen(path)
+    store.add(make_event("a"))
+    store.add(make_event("b", chat_id=2))
+    store.delete("a")
+    occurrence = datetime.fromtimestamp(1790000000, pytz.UTC)
+    store.mark_delivered(store.get("b"), 60, occurrence)
+    store.set_watermark(1789999000)
+    assert (tmp_path / "events.json.journal").read_text().count("\n") == 5
+
+    restored = reopen(path)
+    assert [e["id"] for e in restored.events] == ["b"]
+    assert restored.get("b")["delivered"] == {"60": 1790000000}
+    assert restored.watermark == 1789999000
+    assert [e["id"] for e, _ in restored.chat_events(2)] == ["b"]
+
+
+def test_torn_last_journal_line_is_skipped(tmp_path):
+    path = tmp_path / "events.json"
+    journal = tmp_path / "events.json.journal"
+    store = reopen(path)
+    store.add(make_event("a"))
+    store.add(make_event("b"))
+    # Запись, оборванная на середине (сбой во время дозаписи)
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"op":"add","event":{"id":"c","chat_')
+
+    restored = reopen(path)
+    assert sorted(e["id"] for e in restored.events) == ["a", "b"]
+    # После загрузки журнал свёрнут в снимок, оборванный хвост исчез
+    assert journal.read_text() == ""
+    snapshot = json.loads(path.read_text())
+    assert sorted(e["id"] for e in snapshot["events"]) == ["a", "b"]
+
+
+def test_journal_replay_over_snapshot_is_idempotent(tmp_path):
+    path = tmp_path / "events.json"
+    store = reopen(path)
+    store.add(make_event("a"))
+    store.delete("a")
+    store.add(make_event("b"))
+    records = main.load_journal(store.journal_path)
+    store.compact()
+    # Сбой между записью снимка и обрезкой журнала
+    main.append_journal(records, store.journal_path)
+
+    restored = reopen(path)
+    assert [e["id"] for e in restored.events] == ["b"]
+
+
+def test_compaction_threshold(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "JOURNAL_COMPACT_RECORDS", 3)
+    path = tmp_path / "events.json"
+    store = reopen(path)
+    for event_id in "abc":
+        store.add(make_event(event_id))
+
+    assert (tmp_path / "events.json.journal").read_text() == ""
+    assert len(json.loads(path.read_text())["events"]) == 3
+
+
+def test_v1_snapshot_is_migrated(tmp_path):
+    path = tmp_path / "events.json"
+    legacy = {
+        "id":
+        "old",
+        "chat_id":
+        1,
+        "title":
+        "Старое событие",
+        "event_time":
+        "2025-03-01T07:00:00+00:00",
+        "repeat":
+        "monthly",
+        "notify_minutes": [0, 60],
+        "sent_notifications": [
+            "2025-03-01T07:00:00+00:00_60",
+            "2025-04-01T07:00:00+00:00_60",
+            "2025-03-01T07:00:00+00:00_0",
+            "мусор",
+        ],
+    }
+    path.write_text(json.dumps({"events": [legacy]}), encoding="utf-8")
+
+    store = reopen(path)
+    event = store.get("old")
+    assert "event_time" not in event and "sent_notifications" not in event
+    april = int(datetime(2025, 4, 1, 7, tzinfo=pytz.UTC).timestamp())
+    march = int(datetime(2025, 3, 1, 7, tzinfo=pytz.UTC).timestamp())
+    assert event["event_at"] == march
+    assert event["delivered"] == {"60": april, "0": march}
+
+    # Снимок переписан в новом формате
+    snapshot = json.loads(path.read_text())
+    assert snapshot["version"] == main.SCHEMA_VERSION
+    assert snapshot["events"][0]["event_at"] == march
+    assert reopen(path).get("old")["delivered"] == event["delivered"]
+
+
+def test_v1_sent_journal_record_is_migrated(tmp_path):
+    path = tmp_path / "events.json"
+    legacy = {
+        "id": "old",
+        "chat_id": 1,
+        "title": "Старое событие",
+        "event_time": "2025-03-01T07:00:00",
+        "repeat": "once",
+        "notify_minutes": [0],
+    }
+    path.write_text(json.dumps({"events": [legacy]}), encoding="utf-8")
+    main.append_journal([{
+        "op": "sent",
+        "id": "old",
+        "sent": ["2025-03-01T07:00:00_0"]
+    }], f"{path}.journal")
+
+    event = reopen(path).get("old")
+    march = int(datetime(2025, 3, 1, 7, tzinfo=pytz.UTC).timestamp())
+    assert event["event_at"] == march
+    assert event["delivered"] == {"0": march}
+
+
+def test_snapshot_is_immutable_copy(tmp_path):
+    store = reopen(tmp_path / "events.json")
+    store.add(make_event("a"))
+    store.put_retry({"key": "k", "event_id": "a", "next_try": 1})
+    meta, events = store.snapshot()
+
+    occurrence = datetime.fromtimestamp(1790000000, pytz.UTC)
+    store.mark_delivered(store.get("a"), 0, occurrence)
+    store.put_retry({"key": "k2", "event_id": "a", "next_try": 2})
+    assert json.loads(events[0])["delivered"] == {}
+    assert list(json.loads(meta)["outbox"]) == ["k"]
+    # Строка события обновляется вместе с ним
+    assert json.loads(store.snapshot()[1][0])["delivered"] == {"0": 1790000000}
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = tmp_path / "events.json"
+    store = reopen(path)
+    store.add(make_event("a", title="Строка с \n переводом, и запятой"))
+    store.add(make_event("b", chat_id=2))
+    store.compact()
+
+    # Снимок остаётся обычным JSON
+    assert len(json.loads(path.read_text())["events"]) == 2
+    restored = reopen(path)
+    assert restored.get("a")["title"] == "Строка с \n переводом, и запятой"
+    assert restored._json == store._json
+
+
+def open_sqlite(tmp_path):
+    store = main.SqliteEventStore(str(tmp_path / "events.db"),
+                                  json_path=str(tmp_path / "events.json"))
+    store.load()
+    return store
+
+
+def test_sqlite_restart_does_not_rewrite_rows(tmp_path):
+    store = open_sqlite(tmp_path)
+    store.add(make_event("a"))
+    store.add(make_event("b", chat_id=2))
+    store.delete("a")
+    store._db.close()
+
+    restored = open_sqlite(tmp_path)
+    assert [e["id"] for e in restored.events] == ["b"]
+    assert restored._db.total_changes == 0
+
+
+def test_watermark_saved_on_interval_and_close(tmp_path):
+    path = tmp_path / "events.json"
+    journal = tmp_path / "events.json.journal"
+    store = reopen(path)
+    start = 1790000000
+    for tick in range(10):
+        store.set_watermark(start + tick * 30)
+    # Первый сдвиг записан, остальные в пределах интервала — только в памяти
+    assert journal.read_text().count("\n") == 1
+    assert store.watermark == start + 270
+
+    store.set_watermark(start + main.WATERMARK_SAVE_INTERVAL)
+    assert journal.read_text().count("\n") == 2
+
+    store.set_watermark(start + main.WATERMARK_SAVE_INTERVAL + 30)
+    asyncio.run(store.close())
+    assert reopen(path).watermark == start + main.WATERMARK_SAVE_INTERVAL + 30